@@ -0,0 +1,166 @@
+"""Bounded async execution of LLM calls: concurrency limit, prioritized fair queue, per-call timeouts, load shedding and stats."""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Tuple, TypeVar
+
+from ai.scheduler import FairQueue, PRIORITY_HIGH, PRIORITY_LOW
+
+T = TypeVar("T")
+
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "100"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+# Share of the queue random-chance replies may occupy
+LLM_LOW_PRIORITY_SHARE = float(os.getenv("LLM_LOW_PRIORITY_SHARE", "0.5"))
+# Random-chance replies are throttled as p95 call latency approaches this (seconds)
+LLM_TARGET_LATENCY = float(os.getenv("LLM_TARGET_LATENCY", "10"))
+_LATENCY_WINDOW = 120.0
+
+
+class LLMQueueFull(Exception):
+    """Raised when a call can't be queued, or was shed from the queue to make room for a more important one."""
+
+
+class LLMEngine:
+    """Runs LLM jobs (coroutine factories) on a fixed number of async workers fed by a bounded queue."""
+
+    def __init__(self, concurrency: int = LLM_CONCURRENCY, queue_size: int = LLM_QUEUE_SIZE, timeout: float = LLM_TIMEOUT):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._queue: Optional[FairQueue] = None
+        # (finished at, duration) of recently completed calls
+        self._latencies: Deque[Tuple[float, float]] = deque(maxlen=200)
+        self._workers: List[asyncio.Task] = []
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.rejected = 0
+        self.shed = 0
+
+    def _ensure_started(self) -> FairQueue:
+        if self._queue is None:
+            self._queue = FairQueue(self.queue_size, LLM_LOW_PRIORITY_SHARE)
+            self._workers = [asyncio.ensure_future(self._worker()) for _ in range(self.concurrency)]
+        return self._queue
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(
+        self,
+        job: Callable[[], Awaitable[T]],
+        timeout: Optional[float] = None,
+        priority: int = PRIORITY_HIGH,
+        key: Hashable = None,
+    ) -> T:
+        """Queue `job` and wait for its result.
+
+        `priority` is PRIORITY_HIGH or PRIORITY_LOW; `key` (the guild) is the unit of
+        fair queuing. Raises LLMQueueFull if the job can't be queued or is shed, and
+        asyncio.TimeoutError if the call runs longer than `timeout` (default LLM_TIMEOUT).
+        Cancelling the caller cancels the job, whether it is still queued or already running.
+        """
+        queue = self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            evicted = queue.put_nowait((job, timeout if timeout is not None else self.timeout, future), priority, key)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise LLMQueueFull(f"LLM queue full ({queue.qsize()} pending)")
+        if evicted is not None and not evicted[2].done():
+            self.shed += 1
+            evicted[2].set_exception(LLMQueueFull("shed for a higher-priority reply"))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    async def _worker(self) -> None:
+        queue = self._queue
+        while True:
+            job, timeout, future = await queue.get()
+            try:
+                if future.done():
+                    # Cancelled while still queued
+                    self.cancelled += 1
+                    continue
+                await self._run(job, timeout, future)
+            finally:
+                queue.task_done()
+
+    async def _run(self, job, timeout: float, future: asyncio.Future) -> None:
+        self.in_flight += 1
+        task = asyncio.ensure_future(asyncio.wait_for(job(), timeout))
+        future.add_done_callback(lambda f: task.cancel() if f.cancelled() else None)
+        started = time.monotonic()
+        try:
+            await asyncio.wait({task})
+        finally:
+            self.in_flight -= 1
+        if not task.cancelled():
+            # Timeouts count as the full deadline so they push the load up
+            elapsed = timeout if isinstance(task.exception(), asyncio.TimeoutError) else time.monotonic() - started
+            self._latencies.append((time.monotonic(), elapsed))
+        if task.cancelled():
+            self.cancelled += 1
+            future.cancel()
+            return
+        exc = task.exception()
+        if exc is None:
+            self.completed += 1
+            if not future.done():
+                future.set_result(task.result())
+            return
+        if isinstance(exc, asyncio.TimeoutError):
+            self.timed_out += 1
+        else:
+            self.failed += 1
+        if not future.done():
+            future.set_exception(exc)
+
+    def latency_p95(self) -> float:
+        """p95 duration of calls finished in the last _LATENCY_WINDOW seconds."""
+        since = time.monotonic() - _LATENCY_WINDOW
+        latencies = sorted(elapsed for finished, elapsed in self._latencies if finished >= since)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+
+    def load(self) -> float:
+        """0 when idle, 1 or more when saturated: the worse of queue fill and p95 latency vs LLM_TARGET_LATENCY."""
+        queued = self._queue.depth(PRIORITY_LOW) / self._queue.low_limit if self._queue is not None else 0.0
+        return max(queued, self.latency_p95() / LLM_TARGET_LATENCY)
+
+    def effective_reply_chance(self, base: float) -> float:
+        """Scale the random reply chance down as load rises past half, reaching 0 when saturated."""
+        load = self.load()
+        if load <= 0.5:
+            return base
+        return base * max(0.0, (1.0 - load) / 0.5)
+
+    def stats(self) -> Dict[str, int]:
+        """Queue depth, in-flight count and outcome counters."""
+        return {
+            "queued": self.queue_depth,
+            "queued_high": self._queue.depth(PRIORITY_HIGH) if self._queue is not None else 0,
+            "queued_low": self._queue.depth(PRIORITY_LOW) if self._queue is not None else 0,
+            "in_flight": self.in_flight,
+            "concurrency": self.concurrency,
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "cancelled": self.cancelled,
+            "rejected": self.rejected,
+            "shed": self.shed,
+            "latency_p95": round(self.latency_p95(), 3),
+        }
+
+
+engine = LLMEngine()
@@ -1,20 +1,51 @@
 """Gemini LLM integration and message utilities for AI replies."""
+import asyncio
 import os
 import re
-from typing import List, Optional
+from typing import AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
 
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import SystemMessage, HumanMessage
+from ai.prefix import Prefix, prompt_prefixes, render_prefix
+from ai.rules import MESSAGE_PROMPT, SUMMARY_PROMPT
+from ai.tokens import budget_context_lines, token_estimator
+from ai.router import MODEL_FAST, MODEL_FULL, TIER_FULL, model_router
 
-from ai.rules import SYSTEM_PROMPT, DEFAULT_PERSONALITY
+# Cheaper model for background work like conversation summaries
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", MODEL_FAST)
 
-llm = ChatGoogleGenerativeAI(
-    model="gemini-3-flash-preview",
-    google_api_key=os.getenv("GOOGLE_API_KEY"),
-    temperature=1,
-)
+# (model, temperature) -> chat model. Built on first use (or by warm_up() after connecting):
+# importing the LangChain/Gemini SDK is slow
+_llms: Dict[Tuple[str, float], object] = {}
 
 
+def get_llm(model: str = MODEL_FULL, temperature: float = 1):
+    """Return the shared chat model for `model`, importing the SDK and building the client on first call."""
+    llm = _llms.get((model, temperature))
+    if llm is None:
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        llm = _llms[(model, temperature)] = ChatGoogleGenerativeAI(
+            model=model,
+            google_api_key=os.getenv("GOOGLE_API_KEY"),
+            temperature=temperature,
+        )
+    return llm
+
+
+def get_summary_llm():
+    """Return the shared model used for conversation summaries."""
+    return get_llm(SUMMARY_MODEL, temperature=0.2)
+
+
+def warm_up() -> None:
+    """Import the SDK and build the clients ahead of the first reply (blocking; run in a thread)."""
+    for tier in model_router.tiers.values():
+        model_router.model(tier.name)
+    import langchain_core.messages  # noqa: F401
+
+
+# The model separates consecutive chat messages with this (see ai/rules.py)
+REPLY_SEPARATOR = "|||"
+
 # Custom emoji in content: <:name:id> or <a:name:id> (animated)
 _CUSTOM_EMOJI_RE = re.compile(r"<(a?):[\w]+:(\d+)>")
 
@@ -42,12 +73,11 @@ def get_media_urls_from_message(message) -> List[str]:
     for att in message.attachments:
         urls.append(att.url)
     for embed in message.embeds:
-        if getattr(embed.image, "url", None):
-            urls.append(embed.image.url)
-        if getattr(embed.thumbnail, "url", None):
-            urls.append(embed.thumbnail.url)
-        if getattr(getattr(embed, "video", None), "url", None):
-            urls.append(embed.video.url)
+        # Link previews point at arbitrary sites; use Discord's proxied copy instead
+        for item in (embed.image, embed.thumbnail, getattr(embed, "video", None)):
+            url = getattr(item, "proxy_url", None)
+            if url:
+                urls.append(url)
     for sticker in getattr(message, "stickers", []):
         if getattr(sticker, "url", None):
             urls.append(sticker.url)
@@ -55,48 +85,43 @@ def get_media_urls_from_message(message) -> List[str]:
     return urls
 
 
-def build_context_from_messages(messages: List, include_media: bool = True) -> str:
-    """Format messages as context (text only, or text + attachment/embed URLs if include_media)."""
-    lines = []
-    for msg in messages:
-        author = msg.author.display_name if hasattr(msg.author, 'display_name') else str(msg.author)
-        content = (msg.content or "(no text)").strip()
-        if not content and (msg.attachments or msg.embeds):
-            content = "(media)"
-        if include_media:
-            extra: List[str] = []
-            for att in msg.attachments:
-                extra.append(att.url)
-            for embed in msg.embeds:
-                img_url = getattr(embed.image, "url", None)
-                if img_url:
-                    extra.append(img_url)
-                thumb_url = getattr(embed.thumbnail, "url", None)
-                if thumb_url:
-                    extra.append(thumb_url)
-                video_url = getattr(getattr(embed, "video", None), "url", None)
-                if video_url:
-                    extra.append(video_url)
-            if extra:
-                content = f"{content} [media: {' '.join(extra)}]"
-        lines.append(f"{author}: {content}")
+def build_context_from_messages(
+    records: List,
+    include_media: bool = True,
+    budget: Optional[int] = None,
+    priority: Optional[Callable[[object], bool]] = None,
+) -> str:
+    """Format buffered MessageRecords as context (text only, or text + media URLs if include_media).
+
+    Long messages are elided; with a `budget` (estimated tokens), older lines are dropped to fit,
+    sparing those where `priority(record)` is true (see ai/tokens.py).
+    """
+    lines = budget_context_lines(records, include_media, budget, priority)
     return "\n".join(lines) if lines else "(no previous messages)"
 
 
-def get_gemini_reply(
+def build_prompt_messages(
     user_message: str,
     context: str,
     media_urls: Optional[List[str]] = None,
     personality: Optional[str] = None,
     name: str = "Untitled",
-) -> Optional[str]:
-    """Call Gemini with system prompt, context, and optional attachment/embed URLs; return reply text or None."""
-    personality_text = (personality or DEFAULT_PERSONALITY).strip()
-    display_name = (name or "Untitled").strip() or "Untitled"
-    system_text = SYSTEM_PROMPT.format(context=context, personality=personality_text, name=display_name)
+    summary: Optional[str] = None,
+    prefix: Optional[Prefix] = None,
+) -> List:
+    """Build the system + human messages for a reply.
+
+    The system message is the server's cached prefix (see ai/prefix.py); summary, recent
+    context and the message being answered go in the human turn after it.
+    """
+    from langchain_core.messages import HumanMessage
+
+    if prefix is None:
+        prefix = render_prefix(0, name, personality)
+    turn_text = MESSAGE_PROMPT.format(context=context, summary=summary or "(nothing yet)") + user_message
     if media_urls:
         content_parts: List = [
-            {"type": "text", "text": user_message}
+            {"type": "text", "text": turn_text}
         ]
         for url in media_urls:
             content_parts.append({
@@ -105,28 +130,159 @@ def get_gemini_reply(
             })
         human_content = content_parts
     else:
-        human_content = user_message
-    messages = [
-        SystemMessage(content=system_text),
+        human_content = turn_text
+    return [
+        prefix.message,
         HumanMessage(content=human_content),
     ]
+
+
+def _report_usage(usage: Optional[dict], estimated: int, on_usage: Optional[Callable[[dict], None]]) -> None:
+    """Compare the estimated prompt size with the reported one, then pass usage on (with the estimate)."""
+    if not usage:
+        return
+    actual = usage.get("input_tokens") or 0
+    token_estimator.observe(estimated, actual)
+    print(f"Prompt tokens: ~{estimated} estimated, {actual} actual")
+    if on_usage is not None:
+        on_usage({**usage, "estimated_input_tokens": estimated})
+
+
+def _use_prompt_cache(messages: List, prefix: Optional[Prefix]):
+    """Router `prepare` hook: reference the prefix's explicit Gemini cache for a model when one is live."""
+    def prepare(model: str):
+        cache_name = prompt_prefixes.cached_content(prefix, model) if prefix is not None else None
+        if cache_name is None:
+            return messages, {}
+        # The cache holds the system message
+        return messages[1:], {"cached_content": cache_name}
+
+    return prepare
+
+
+def _content_text(content, sep: str = " ") -> str:
+    """Flatten model message content (string or list of parts) into text."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        text_parts = []
+        for part in content:
+            if isinstance(part, str):
+                text_parts.append(part)
+            elif isinstance(part, dict) and "text" in part:
+                text_parts.append(part["text"])
+        return sep.join(text_parts)
+    return str(content) if content else ""
+
+
+def response_text(response) -> Optional[str]:
+    """Extract plain reply text from a model response (string or list-of-parts content)."""
+    if response and hasattr(response, "content") and response.content:
+        return _content_text(response.content).strip() or None
+    return None
+
+
+def split_reply(text: Optional[str]) -> List[str]:
+    """Split a reply into the separate messages the model delimited with |||."""
+    if not text:
+        return []
+    return [p.strip() for p in text.split(REPLY_SEPARATOR) if p.strip()]
+
+
+async def get_gemini_reply(
+    user_message: str,
+    context: str,
+    media_urls: Optional[List[str]] = None,
+    personality: Optional[str] = None,
+    name: str = "Untitled",
+    on_usage: Optional[Callable[[dict], None]] = None,
+    summary: Optional[str] = None,
+    tiers: Sequence[str] = (TIER_FULL,),
+    prefix: Optional[Prefix] = None,
+) -> Optional[str]:
+    """Call Gemini with system prompt, context, and optional attachment/embed URLs; return reply text or None.
+
+    `on_usage` receives the response's token usage (LangChain usage_metadata) if reported, plus
+    `estimated_input_tokens`, the local estimate of the prompt size.
+    `summary` is the channel's rolling summary of older messages (see ai/memory.py).
+    `tiers` are the model tiers to try in order (see ai/router.py); raises asyncio.TimeoutError
+    if every tier timed out. `prefix` is the server's cached system prompt (see ai/prefix.py).
+    """
+    messages = build_prompt_messages(user_message, context, media_urls, personality, name, summary, prefix)
+    estimated = token_estimator.estimate_messages(messages)
     try:
-        response = llm.invoke(messages)
-        if response and hasattr(response, "content") and response.content:
-            if isinstance(response.content, str):
-                return response.content.strip()
-            elif isinstance(response.content, list):
-                text_parts = []
-                for part in response.content:
-                    if isinstance(part, str):
-                        text_parts.append(part)
-                    elif isinstance(part, dict) and "text" in part:
-                        text_parts.append(part["text"])
-                return " ".join(text_parts).strip() if text_parts else None
-            else:
-                return str(response.content).strip()
+        response = await model_router.invoke(messages, tiers, _use_prompt_cache(messages, prefix))
+        _report_usage(getattr(response, "usage_metadata", None), estimated, on_usage)
+        return response_text(response)
+    except asyncio.TimeoutError:
+        raise
     except Exception as e:
         print(f"Gemini API error: {e}")
         import traceback
         traceback.print_exc()
     return None
+
+
+async def stream_gemini_reply(
+    user_message: str,
+    context: str,
+    media_urls: Optional[List[str]] = None,
+    personality: Optional[str] = None,
+    name: str = "Untitled",
+    on_usage: Optional[Callable[[dict], None]] = None,
+    summary: Optional[str] = None,
+    tiers: Sequence[str] = (TIER_FULL,),
+    prefix: Optional[Prefix] = None,
+) -> AsyncIterator[str]:
+    """Stream a reply from Gemini, yielding each ||| segment as soon as it is complete.
+
+    `on_usage` receives the token usage summed over the stream's chunks (plus the prompt
+    estimate, as in get_gemini_reply), once the stream ends.
+    """
+    messages = build_prompt_messages(user_message, context, media_urls, personality, name, summary, prefix)
+    estimated = token_estimator.estimate_messages(messages)
+    buffer = ""
+    usage: dict = {}
+    try:
+        async for chunk in model_router.stream(messages, tiers, _use_prompt_cache(messages, prefix)):
+            for key, value in (getattr(chunk, "usage_metadata", None) or {}).items():
+                if isinstance(value, int):
+                    usage[key] = usage.get(key, 0) + value
+            buffer += _content_text(getattr(chunk, "content", ""), sep="")
+            *done, buffer = buffer.split(REPLY_SEPARATOR)
+            for part in done:
+                part = part.strip()
+                if part:
+                    yield part
+    except asyncio.TimeoutError:
+        raise
+    except Exception as e:
+        print(f"Gemini API error: {e}")
+        import traceback
+        traceback.print_exc()
+        return
+    _report_usage(usage, estimated, on_usage)
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def summarize_conversation(
+    summary: Optional[str],
+    records: List,
+    name: str = "Untitled",
+    max_words: int = 120,
+    on_usage: Optional[Callable[[dict], None]] = None,
+) -> Optional[str]:
+    """Fold `records` (MessageRecords) into the running `summary` with the cheap model; raises on API errors."""
+    from langchain_core.messages import HumanMessage
+
+    prompt = SUMMARY_PROMPT.format(
+        name=(name or "Untitled").strip() or "Untitled",
+        max_words=max_words,
+        summary=summary or "(none yet)",
+        messages=build_context_from_messages(records, include_media=False),
+    )
+    response = await get_summary_llm().ainvoke([HumanMessage(content=prompt)])
+    if on_usage is not None and getattr(response, "usage_metadata", None):
+        on_usage(response.usage_metadata)
+    return response_text(response)
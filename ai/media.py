@@ -0,0 +1,250 @@
+"""Media preprocessing for multimodal prompts.
+
+Each media URL is fetched once, downscaled/re-encoded to a bounded size and kept in an
+LRU cache keyed by content hash (bounded by total bytes and entry count), with a
+URL -> hash map so repeated emojis and stickers skip the network entirely. The model
+gets the prepared bytes inline as data URLs instead of raw CDN links.
+
+Fetching is pluggable (`MediaPipeline(fetcher=...)`), e.g. to run against a local
+fixture server offline. Pillow is optional: without it, images are passed through
+unchanged if their type and size are already acceptable.
+"""
+import asyncio
+import base64
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+MEDIA_MAX_DIMENSION = int(os.getenv("MEDIA_MAX_DIMENSION", "1024"))
+# Larger downloads are dropped
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(8 * 1024 * 1024)))
+MEDIA_CACHE_BYTES = int(os.getenv("MEDIA_CACHE_BYTES", str(64 * 1024 * 1024)))
+MEDIA_CACHE_ITEMS = int(os.getenv("MEDIA_CACHE_ITEMS", "1024"))
+# At most this many media items are sent with one message
+MEDIA_MAX_ITEMS = int(os.getenv("MEDIA_MAX_ITEMS", "4"))
+MEDIA_FETCH_TIMEOUT = float(os.getenv("MEDIA_FETCH_TIMEOUT", "10"))
+# Images with more pixels are dropped before decoding (a small compressed file can decode to gigabytes)
+MEDIA_MAX_PIXELS = int(os.getenv("MEDIA_MAX_PIXELS", str(4096 * 4096)))
+# The default fetcher only talks to these hosts (and their subdomains): Discord's CDN and media proxy
+MEDIA_ALLOWED_HOSTS = [h.strip().lower() for h in os.getenv("MEDIA_ALLOWED_HOSTS", "cdn.discordapp.com,discordapp.net").split(",") if h.strip()]
+
+# Image types Gemini accepts inline
+SUPPORTED_TYPES = {"image/png", "image/jpeg", "image/webp"}
+# Types we can convert to a supported one (with Pillow)
+CONVERTIBLE_TYPES = {"image/gif", "image/bmp"}
+
+# url -> (bytes, content type)
+Fetcher = Callable[[str], Awaitable[Tuple[bytes, str]]]
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class MediaHostNotAllowed(Exception):
+    pass
+
+
+def _allowed(url: str) -> bool:
+    """Whether `url` is https on an allowed host, so message content can't point the bot at arbitrary hosts."""
+    from urllib.parse import urlsplit
+
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    return parts.scheme == "https" and any(host == h or host.endswith("." + h) for h in MEDIA_ALLOWED_HOSTS)
+
+
+class PreparedMedia(NamedTuple):
+    mime_type: str
+    data: bytes
+
+    @property
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{base64.b64encode(self.data).decode('ascii')}"
+
+
+_session = None
+
+
+async def http_fetch(url: str) -> Tuple[bytes, str]:
+    """Default fetcher: GET with aiohttp (a discord.py dependency), refusing bodies over MEDIA_MAX_BYTES.
+
+    Only MEDIA_ALLOWED_HOSTS are fetched and redirects are not followed.
+    """
+    global _session
+    import aiohttp
+
+    if not _allowed(url):
+        raise MediaHostNotAllowed(url)
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=MEDIA_FETCH_TIMEOUT))
+    async with _session.get(url, allow_redirects=False) as resp:
+        resp.raise_for_status()
+        if resp.content_length and resp.content_length > MEDIA_MAX_BYTES:
+            raise MediaTooLarge(f"{resp.content_length} bytes")
+        data = await resp.content.read(MEDIA_MAX_BYTES + 1)
+        if len(data) > MEDIA_MAX_BYTES:
+            raise MediaTooLarge(f"over {MEDIA_MAX_BYTES} bytes")
+        return data, (resp.content_type or "").lower()
+
+
+class MediaCache:
+    """LRU of prepared media keyed by content hash, bounded by total bytes and entry count."""
+
+    def __init__(self, max_bytes: int = MEDIA_CACHE_BYTES, max_items: int = MEDIA_CACHE_ITEMS):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.size = 0
+        # content hash -> prepared media (None: fetched but unusable)
+        self._items: "OrderedDict[str, Optional[PreparedMedia]]" = OrderedDict()
+        # url -> content hash
+        self._urls: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def lookup_url(self, url: str) -> Tuple[bool, Optional[PreparedMedia]]:
+        """(found, media) for a URL seen before; media is None if that URL was unusable."""
+        digest = self._urls.get(url)
+        if digest is None or digest not in self._items:
+            self.misses += 1
+            return False, None
+        self._urls.move_to_end(url)
+        self._items.move_to_end(digest)
+        self.hits += 1
+        return True, self._items[digest]
+
+    def lookup_hash(self, digest: str) -> Tuple[bool, Optional[PreparedMedia]]:
+        if digest not in self._items:
+            return False, None
+        self._items.move_to_end(digest)
+        return True, self._items[digest]
+
+    def put(self, url: str, digest: str, media: Optional[PreparedMedia]) -> None:
+        if digest in self._items:
+            self._items.move_to_end(digest)
+        else:
+            self._items[digest] = media
+            self.size += len(media.data) if media else 0
+        self._urls[url] = digest
+        self._urls.move_to_end(url)
+        while self._items and (self.size > self.max_bytes or len(self._items) > self.max_items):
+            _, evicted = self._items.popitem(last=False)
+            self.size -= len(evicted.data) if evicted else 0
+        while len(self._urls) > self.max_items * 4:
+            self._urls.popitem(last=False)
+
+
+def _sniff_type(data: bytes, declared: str) -> str:
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    return declared.split(";")[0].strip()
+
+
+def _process(data: bytes, mime_type: str, max_dimension: int) -> Optional[PreparedMedia]:
+    """Downscale/re-encode to a supported type within max_dimension; None if unusable (blocking)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return PreparedMedia(mime_type, data) if mime_type in SUPPORTED_TYPES else None
+    try:
+        image = Image.open(io.BytesIO(data))
+        # Only the header has been read so far; refuse to decode huge images
+        if image.width * image.height > MEDIA_MAX_PIXELS:
+            print(f"Dropping media ({mime_type}): {image.width}x{image.height} is over {MEDIA_MAX_PIXELS} pixels")
+            return None
+        image.seek(0)  # first frame of animations
+        if max(image.size) <= max_dimension and mime_type in SUPPORTED_TYPES:
+            return PreparedMedia(mime_type, data)
+        image.thumbnail((max_dimension, max_dimension))
+        out = io.BytesIO()
+        if image.mode in ("RGBA", "LA", "P"):
+            image.convert("RGBA").save(out, format="PNG", optimize=True)
+            return PreparedMedia("image/png", out.getvalue())
+        image.convert("RGB").save(out, format="JPEG", quality=85)
+        return PreparedMedia("image/jpeg", out.getvalue())
+    except Exception as e:
+        print(f"Could not process media ({mime_type}): {e}")
+        return None
+
+
+class MediaPipeline:
+    """Turns media URLs into inline data URLs, fetching and processing each asset at most once."""
+
+    def __init__(self, fetcher: Optional[Fetcher] = None, cache: Optional[MediaCache] = None, max_dimension: int = MEDIA_MAX_DIMENSION):
+        self.fetcher = fetcher or http_fetch
+        self.cache = cache or MediaCache()
+        self.max_dimension = max_dimension
+        # url -> in-flight preparation, so concurrent replies share one fetch
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.dropped = 0
+
+    async def prepare(self, urls: List[str]) -> List[str]:
+        """Return data URLs for the usable media among `urls` (deduplicated, in order, at most MEDIA_MAX_ITEMS)."""
+        # Some URLs may turn out unusable, so look at a few more than we can send
+        unique = list(dict.fromkeys(urls))[:MEDIA_MAX_ITEMS * 2]
+        results = await asyncio.gather(*(self._prepare_one(url) for url in unique))
+        seen = set()
+        prepared = []
+        for media in results:
+            if media is None or media.data in seen:
+                continue
+            seen.add(media.data)
+            prepared.append(media.data_url)
+        return prepared[:MEDIA_MAX_ITEMS]
+
+    async def _prepare_one(self, url: str) -> Optional[PreparedMedia]:
+        found, media = self.cache.lookup_url(url)
+        if found:
+            return media
+        task = self._inflight.get(url)
+        if task is None:
+            task = self._inflight[url] = asyncio.ensure_future(self._fetch_and_process(url))
+            task.add_done_callback(lambda _t: self._inflight.pop(url, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_and_process(self, url: str) -> Optional[PreparedMedia]:
+        try:
+            data, declared = await self.fetcher(url)
+        except Exception as e:
+            # Not cached: the failure may be transient
+            self.dropped += 1
+            print(f"Dropping media {url}: {e}")
+            return None
+        if len(data) > MEDIA_MAX_BYTES:
+            self.dropped += 1
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        found, media = self.cache.lookup_hash(digest)
+        if not found:
+            mime_type = _sniff_type(data, declared)
+            if mime_type in SUPPORTED_TYPES or mime_type in CONVERTIBLE_TYPES:
+                media = await asyncio.to_thread(_process, data, mime_type, self.max_dimension)
+            else:
+                media = None
+        if media is None:
+            self.dropped += 1
+        self.cache.put(url, digest, media)
+        return media
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "cache_bytes": self.cache.size,
+            "cache_items": len(self.cache),
+            "hits": self.cache.hits,
+            "misses": self.cache.misses,
+            "dropped": self.dropped,
+        }
+
+
+media_pipeline = MediaPipeline()
@@ -0,0 +1,125 @@
+"""Rolling per-channel conversation summary: longer memory at a fixed prompt cost.
+
+Replies see the last few messages verbatim. Messages older than that window roll
+into a short running summary per channel, which a cheap model refreshes in the
+background once MEMORY_REFRESH_EVERY messages have rolled off. Refreshes run as
+low-priority LLM engine jobs, so under load they are shed first and simply retried
+on a later message.
+"""
+import asyncio
+import functools
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from ai.engine import engine, LLMQueueFull
+from ai.gemini import summarize_conversation
+from ai.scheduler import PRIORITY_LOW
+
+# Messages that must roll off the recent window before the summary is refreshed (0 disables)
+MEMORY_REFRESH_EVERY = int(os.getenv("MEMORY_REFRESH_EVERY", "15"))
+MEMORY_SUMMARY_WORDS = int(os.getenv("MEMORY_SUMMARY_WORDS", "120"))
+
+
+class _ChannelMemory:
+    __slots__ = ('summary', 'pending', 'task')
+
+    def __init__(self):
+        self.summary: Optional[str] = None
+        # Messages not folded into the summary yet, oldest first (includes the recent window)
+        self.pending: List = []
+        self.task: Optional[asyncio.Task] = None
+
+
+class ConversationMemory:
+    """Per-channel running summaries of messages older than the recent window."""
+
+    def __init__(
+        self,
+        window: int,
+        refresh_every: int = MEMORY_REFRESH_EVERY,
+        max_words: int = MEMORY_SUMMARY_WORDS,
+        on_usage: Optional[Callable[[int, dict], None]] = None,
+    ):
+        self.window = window
+        self.refresh_every = refresh_every
+        self.max_words = max_words
+        # Called with (server_id, usage) for each summary call
+        self.on_usage = on_usage
+        # Rolled-off messages kept while refreshes keep failing; older ones are dropped
+        self.max_backlog = refresh_every * 4
+        self._channels: Dict[int, _ChannelMemory] = {}
+        self.refreshes = 0
+        self.failed = 0
+        self.shed = 0
+
+    def summaries(self) -> Iterable[Tuple[int, str]]:
+        """(channel_id, summary) for every channel that has one."""
+        return [(channel_id, m.summary) for channel_id, m in self._channels.items() if m.summary]
+
+    def restore_summary(self, channel_id: int, summary: str) -> None:
+        memory = self._channels.get(channel_id)
+        if memory is None:
+            memory = self._channels[channel_id] = _ChannelMemory()
+        memory.summary = summary
+
+    def summary(self, channel_id: int) -> Optional[str]:
+        memory = self._channels.get(channel_id)
+        return memory.summary if memory is not None else None
+
+    def observe(self, server_id: int, channel_id: int, record, name: str) -> None:
+        """Note a new message; start a background refresh once enough have rolled off the window."""
+        if self.refresh_every <= 0:
+            return
+        memory = self._channels.get(channel_id)
+        if memory is None:
+            memory = self._channels[channel_id] = _ChannelMemory()
+        memory.pending.append(record)
+        rolled_off = len(memory.pending) - self.window
+        if rolled_off > self.max_backlog:
+            del memory.pending[:rolled_off - self.max_backlog]
+        if rolled_off >= self.refresh_every and (memory.task is None or memory.task.done()):
+            memory.task = asyncio.ensure_future(self._refresh(server_id, memory, name))
+
+    def remove_messages(self, channel_id: int, message_ids: Iterable[int]) -> None:
+        """Keep deleted messages out of future summaries."""
+        memory = self._channels.get(channel_id)
+        if memory is not None:
+            ids = set(message_ids)
+            memory.pending = [r for r in memory.pending if r.id not in ids]
+
+    def forget(self, channel_id: int) -> None:
+        memory = self._channels.pop(channel_id, None)
+        if memory is not None and memory.task is not None:
+            memory.task.cancel()
+
+    async def _refresh(self, server_id: int, memory: _ChannelMemory, name: str) -> None:
+        batch = memory.pending[:-self.window] if self.window else list(memory.pending)
+        if not batch:
+            return
+        on_usage = functools.partial(self.on_usage, server_id) if self.on_usage is not None else None
+        job = functools.partial(summarize_conversation, memory.summary, batch, name, self.max_words, on_usage)
+        try:
+            summary = await engine.submit(job, priority=PRIORITY_LOW, key=server_id)
+        except LLMQueueFull:
+            self.shed += 1
+            return
+        except Exception as e:
+            self.failed += 1
+            print(f"Conversation summary failed: {e}")
+            return
+        if summary:
+            # Words are ~6 characters; cut runaway output so the prompt cost stays fixed
+            memory.summary = summary[:self.max_words * 8]
+            last_id = batch[-1].id
+            memory.pending = [r for r in memory.pending if r.id > last_id]
+            self.refreshes += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "channels": len(self._channels),
+            "summarized": sum(1 for m in self._channels.values() if m.summary),
+            "pending": sum(max(0, len(m.pending) - self.window) for m in self._channels.values()),
+            "refreshes": self.refreshes,
+            "failed": self.failed,
+            "shed": self.shed,
+        }
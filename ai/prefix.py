@@ -0,0 +1,202 @@
+"""Per-server prompt prefix cache.
+
+The system prompt (rules, name, personality) is the same for every reply in a server,
+so it is rendered once into a SystemMessage and reused until /changename or
+/setpersonality invalidates it; a changed name or personality from anywhere else
+(config sync, cluster relay) is caught by comparing the inputs on lookup.
+
+With PROMPT_CACHE_TTL set, each prefix is also registered with Gemini's explicit context
+caching, once per model. Replies then reference the cache instead of resending the prefix.
+Caches are created and refreshed in the background: a reply never waits on them, it
+just sends the full prompt until the cache is ready. A cache that isn't used lapses at
+its TTL; one in use is extended when it gets close to expiring.
+"""
+import asyncio
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+from ai.rules import SYSTEM_PROMPT, DEFAULT_PERSONALITY
+
+# Seconds an explicit Gemini context cache lives; 0 disables explicit caching
+PROMPT_CACHE_TTL = int(os.getenv("PROMPT_CACHE_TTL", "0"))
+# Don't retry creating a cache for this long after a failure (e.g. prefix below the model's minimum size)
+_RETRY_AFTER = 600.0
+
+
+class Prefix:
+    """A server's rendered system prompt."""
+    __slots__ = ('server_id', 'key', 'text', '_message')
+
+    def __init__(self, server_id: int, key: Tuple[str, str], text: str):
+        self.server_id = server_id
+        self.key = key
+        self.text = text
+        self._message = None
+
+    @property
+    def message(self):
+        """The prefix as a LangChain SystemMessage, built once."""
+        if self._message is None:
+            from langchain_core.messages import SystemMessage
+
+            self._message = SystemMessage(content=self.text)
+        return self._message
+
+
+def prefix_key(name: Optional[str], personality: Optional[str]) -> Tuple[str, str]:
+    """The (display name, personality text) a prefix is rendered from, with defaults applied."""
+    return (name or "Untitled").strip() or "Untitled", (personality or DEFAULT_PERSONALITY).strip()
+
+
+def render_prefix(server_id: int, name: Optional[str], personality: Optional[str]) -> Prefix:
+    key = prefix_key(name, personality)
+    return Prefix(server_id, key, SYSTEM_PROMPT.format(name=key[0], personality=key[1]))
+
+
+class GeminiCacheBackend:
+    """Explicit context caches through the google-genai SDK (blocking; called in a thread)."""
+
+    def __init__(self):
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            from google import genai
+
+            self._client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+        return self._client
+
+    def create(self, model: str, system_instruction: str, ttl: int) -> str:
+        from google.genai import types
+
+        cache = self._get_client().caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(system_instruction=system_instruction, ttl=f"{ttl}s"),
+        )
+        return cache.name
+
+    def refresh(self, name: str, ttl: int) -> None:
+        from google.genai import types
+
+        self._get_client().caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl}s"))
+
+    def delete(self, name: str) -> None:
+        self._get_client().caches.delete(name=name)
+
+
+class _RemoteCache:
+    __slots__ = ('key', 'name', 'expires_at', 'task', 'retry_at', 'dropped')
+
+    def __init__(self, key):
+        self.key = key
+        self.name: Optional[str] = None
+        self.expires_at = 0.0
+        self.task: Optional[asyncio.Task] = None
+        self.retry_at = 0.0
+        # Set once invalidated; a create still running then deletes what it made
+        self.dropped = False
+
+
+class PrefixCache:
+    def __init__(self, ttl: int = PROMPT_CACHE_TTL, backend=None):
+        self.ttl = ttl
+        self.backend = backend or GeminiCacheBackend()
+        self._prefixes: Dict[int, Prefix] = {}
+        # (server_id, model) -> explicit cache state
+        self._remote: Dict[Tuple[int, str], _RemoteCache] = {}
+        self.renders = 0
+        self.invalidations = 0
+        self.remote_hits = 0
+        self.remote_created = 0
+        self.remote_failed = 0
+
+    def get(self, server_id: int, name: Optional[str], personality: Optional[str]) -> Prefix:
+        """The server's prefix, rendered on first use or when its name/personality changed."""
+        prefix = self._prefixes.get(server_id)
+        if prefix is None or prefix.key != prefix_key(name, personality):
+            prefix = self._prefixes[server_id] = render_prefix(server_id, name, personality)
+            self.renders += 1
+        return prefix
+
+    def invalidate(self, server_id: int) -> None:
+        """Drop the server's prefix and its explicit caches (name or personality changed)."""
+        self.invalidations += 1
+        self._prefixes.pop(server_id, None)
+        for cache_key in [k for k in self._remote if k[0] == server_id]:
+            self._drop(cache_key)
+
+    def _drop(self, cache_key: Tuple[int, str]) -> None:
+        remote = self._remote.pop(cache_key)
+        # Not cancelled: the backend call runs in a thread and would still create the cache
+        remote.dropped = True
+        if remote.name is not None:
+            asyncio.ensure_future(self._delete(remote.name))
+
+    async def _delete(self, name: str) -> None:
+        try:
+            await asyncio.to_thread(self.backend.delete, name)
+        except Exception as e:
+            print(f"Failed to delete prompt cache {name}: {e}")
+
+    def cached_content(self, prefix: Prefix, model: str) -> Optional[str]:
+        """Name of a live explicit cache holding `prefix` for `model`, or None (creating one in the background)."""
+        if self.ttl <= 0:
+            return None
+        cache_key = (prefix.server_id, model)
+        remote = self._remote.get(cache_key)
+        if remote is not None and remote.key != prefix.key:
+            self._drop(cache_key)
+            remote = None
+        if remote is None:
+            remote = self._remote[cache_key] = _RemoteCache(prefix.key)
+        now = time.monotonic()
+        busy = remote.task is not None and not remote.task.done()
+        # Keep a margin so a request never references a cache that expires mid-flight
+        live = remote.name is not None and remote.expires_at - now > min(60.0, self.ttl / 4)
+        if not busy and now >= remote.retry_at:
+            if remote.name is None or remote.expires_at <= now:
+                remote.name = None
+                remote.task = asyncio.ensure_future(self._create(remote, model, prefix.text))
+            elif remote.expires_at - now < self.ttl / 2:
+                remote.task = asyncio.ensure_future(self._refresh(remote))
+        if live:
+            self.remote_hits += 1
+            return remote.name
+        return None
+
+    async def _create(self, remote: _RemoteCache, model: str, text: str) -> None:
+        try:
+            name = await asyncio.to_thread(self.backend.create, model, text, self.ttl)
+            self.remote_created += 1
+            if remote.dropped:
+                await self._delete(name)
+                return
+            remote.name = name
+            remote.expires_at = time.monotonic() + self.ttl
+        except Exception as e:
+            self.remote_failed += 1
+            remote.retry_at = time.monotonic() + _RETRY_AFTER
+            print(f"Failed to create prompt cache for {model}: {e}")
+
+    async def _refresh(self, remote: _RemoteCache) -> None:
+        try:
+            await asyncio.to_thread(self.backend.refresh, remote.name, self.ttl)
+            remote.expires_at = time.monotonic() + self.ttl
+        except Exception as e:
+            # Let it lapse; the next use past expiry creates a new one
+            print(f"Failed to extend prompt cache {remote.name}: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "prefixes": len(self._prefixes),
+            "renders": self.renders,
+            "invalidations": self.invalidations,
+            "remote_caches": sum(1 for r in self._remote.values() if r.name),
+            "remote_hits": self.remote_hits,
+            "remote_created": self.remote_created,
+            "remote_failed": self.remote_failed,
+        }
+
+
+prompt_prefixes = PrefixCache()
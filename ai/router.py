@@ -0,0 +1,196 @@
+"""Model tiers for replies: routing, per-tier deadlines, fallback and hedged requests.
+
+Random-chance replies go to the fast, cheap tier; direct interactions (mentions,
+replies to the bot) and messages with images go to the full model. A server can pin
+all its replies to one tier with /setmodel. Each tier has a deadline; on an error or
+timeout the call falls back to the other tier. With MODEL_HEDGING=1, a call still
+unanswered after the tier's recent p95 latency gets a second identical request and
+the first to answer wins.
+
+For streamed replies the deadline, fallback and hedging cover the wait for the first
+chunk; once parts have been sent the stream can't switch models.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+TIER_FULL = "full"
+TIER_FAST = "fast"
+# Values of ServerConfig.model_tier; None/"auto" means route by message
+TIER_AUTO = "auto"
+
+MODEL_FULL = os.getenv("GEMINI_MODEL", "gemini-3-flash-preview")
+MODEL_FAST = os.getenv("GEMINI_FAST_MODEL", "gemini-2.5-flash-lite")
+MODEL_FULL_TIMEOUT = float(os.getenv("MODEL_FULL_TIMEOUT", "30"))
+MODEL_FAST_TIMEOUT = float(os.getenv("MODEL_FAST_TIMEOUT", "10"))
+MODEL_HEDGING = os.getenv("MODEL_HEDGING", "0") == "1"
+# Latency samples needed before hedging kicks in
+_HEDGE_MIN_SAMPLES = 20
+
+
+# model name -> (messages, extra model kwargs) for that model, e.g. to reference a context cache
+Prepare = Callable[[str], Tuple[list, dict]]
+
+
+class Tier(NamedTuple):
+    name: str
+    model: str
+    timeout: float
+
+
+def _default_factory(model: str):
+    from ai.gemini import get_llm
+
+    return get_llm(model)
+
+
+class ModelRouter:
+    """Picks a tier for each reply and runs the call with deadline, fallback and optional hedging."""
+
+    def __init__(self, tiers: Sequence[Tier], hedging: bool = MODEL_HEDGING, factory: Callable[[str], object] = _default_factory):
+        self.tiers: Dict[str, Tier] = {tier.name: tier for tier in tiers}
+        self.hedging = hedging
+        # model name -> chat model; tests and bench/ swap in stubs here
+        self.factory = factory
+        # tier -> recent seconds until the model started answering
+        self._latencies: Dict[str, Deque[float]] = {name: deque(maxlen=100) for name in self.tiers}
+        self.calls: Dict[str, int] = {name: 0 for name in self.tiers}
+        self.timeouts = 0
+        self.errors = 0
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def route(self, server_tier: Optional[str], direct: bool, has_media: bool) -> List[str]:
+        """Tiers to try in order: the chosen one, then the others as fallbacks."""
+        if server_tier in self.tiers:
+            primary = server_tier
+        elif direct or has_media:
+            primary = TIER_FULL
+        else:
+            primary = TIER_FAST
+        return [primary] + [name for name in self.tiers if name != primary]
+
+    def model(self, tier: str):
+        return self.factory(self.tiers[tier].model)
+
+    def hedge_delay(self, tier: str) -> Optional[float]:
+        """The tier's p95 latency, once there are enough samples to trust it."""
+        samples = self._latencies[tier]
+        if not self.hedging or len(samples) < _HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(0.95 * len(ordered)))]
+
+    def _request(self, tier: str, messages, prepare) -> Tuple[list, dict]:
+        if prepare is None:
+            return messages, {}
+        return prepare(self.tiers[tier].model)
+
+    async def invoke(self, messages, tiers: Sequence[str], prepare: Optional[Prepare] = None):
+        """ainvoke() on the first tier that answers in time."""
+        def start(tier):
+            request, kwargs = self._request(tier, messages, prepare)
+            return self.model(tier).ainvoke(request, **kwargs)
+
+        return await self._with_fallback(tiers, start)
+
+    async def stream(self, messages, tiers: Sequence[str], prepare: Optional[Prepare] = None) -> AsyncIterator:
+        """astream() from the first tier whose first chunk arrives in time."""
+        def start(tier):
+            request, kwargs = self._request(tier, messages, prepare)
+            return _open_stream(self.model(tier).astream(request, **kwargs))
+
+        opened = await self._with_fallback(tiers, start, _close_stream)
+        if opened is None:
+            return
+        first, chunks = opened
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
+    async def _with_fallback(self, tiers: Sequence[str], start: Callable[[str], Awaitable], discard=None):
+        error: Optional[BaseException] = None
+        for i, tier in enumerate(tiers):
+            if i:
+                self.fallbacks += 1
+                print(f"Falling back to {tier} model: {error!r}")
+            try:
+                return await self._hedged(tier, lambda: start(tier), discard)
+            except asyncio.TimeoutError as e:
+                self.timeouts += 1
+                error = e
+            except Exception as e:
+                self.errors += 1
+                error = e
+        raise error if error is not None else RuntimeError("no model tiers")
+
+    async def _hedged(self, tier: str, start: Callable[[], Awaitable], discard=None):
+        """Run start() within the tier's deadline, racing a second copy if it passes the p95."""
+        deadline = self.tiers[tier].timeout
+        started = time.monotonic()
+        self.calls[tier] += 1
+        primary = asyncio.ensure_future(start())
+        tasks = {primary}
+        try:
+            hedge_after = self.hedge_delay(tier)
+            if hedge_after is not None and hedge_after < deadline:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    self.hedges += 1
+                    self.calls[tier] += 1
+                    tasks.add(asyncio.ensure_future(start()))
+            error: Optional[BaseException] = None
+            while tasks:
+                remaining = deadline - (time.monotonic() - started)
+                done, _ = await asyncio.wait(tasks, timeout=max(0.0, remaining), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError(f"{tier} model took longer than {deadline:g}s")
+                for task in done:
+                    tasks.discard(task)
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        self._latencies[tier].append(time.monotonic() - started)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+                if discard is not None:
+                    task.add_done_callback(lambda t: discard(t.result()) if not t.cancelled() and t.exception() is None else None)
+
+    def stats(self) -> Dict[str, float]:
+        stats = {f"calls_{name}": count for name, count in self.calls.items()}
+        stats.update({
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+        })
+        return stats
+
+
+async def _open_stream(stream):
+    """Start a stream and wait for its first chunk; returns (first chunk, rest) or None if empty."""
+    chunks = stream.__aiter__()
+    try:
+        first = await chunks.__anext__()
+    except StopAsyncIteration:
+        return None
+    return first, chunks
+
+
+def _close_stream(opened) -> None:
+    if opened is not None:
+        asyncio.ensure_future(opened[1].aclose())
+
+
+model_router = ModelRouter([
+    Tier(TIER_FULL, MODEL_FULL, MODEL_FULL_TIMEOUT),
+    Tier(TIER_FAST, MODEL_FAST, MODEL_FAST_TIMEOUT),
+])
@@ -0,0 +1,104 @@
+"""Priority + per-guild fair queue feeding the LLM engine.
+
+Direct interactions (name mentions, replies to the bot) are always served before
+random-chance replies. Within a priority, guilds take turns one job at a time (round
+robin), so one busy server can't starve the others. When the queue is full, low-priority
+work is shed first: new random-chance jobs are refused once they fill their share,
+and a direct interaction evicts a queued random-chance job from the busiest guild.
+"""
+import asyncio
+from collections import OrderedDict, deque
+from typing import Deque, Hashable, List, Optional
+
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+
+
+class FairQueue:
+    def __init__(self, maxsize: int, low_share: float = 0.5):
+        self.maxsize = maxsize
+        # Max queued low-priority jobs
+        self.low_limit = max(1, int(maxsize * low_share))
+        # priority -> guild key -> queued items; key order is the round-robin order
+        self._levels: List["OrderedDict[Hashable, Deque]"] = [OrderedDict(), OrderedDict()]
+        self._depths = [0, 0]
+        self._getters: Deque[asyncio.Future] = deque()
+
+    def qsize(self) -> int:
+        return self._depths[PRIORITY_HIGH] + self._depths[PRIORITY_LOW]
+
+    def depth(self, priority: int) -> int:
+        return self._depths[priority]
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def put_nowait(self, item, priority: int = PRIORITY_HIGH, key: Hashable = None) -> Optional[object]:
+        """Queue `item`; returns a low-priority item evicted to make room, if any.
+
+        Raises asyncio.QueueFull if the item can't be admitted.
+        """
+        evicted = None
+        if priority == PRIORITY_LOW and self._depths[PRIORITY_LOW] >= self.low_limit:
+            raise asyncio.QueueFull
+        if self.qsize() >= self.maxsize:
+            if priority == PRIORITY_LOW or not self._depths[PRIORITY_LOW]:
+                raise asyncio.QueueFull
+            evicted = self._evict_low()
+        queues = self._levels[priority]
+        queue = queues.get(key)
+        if queue is None:
+            queue = queues[key] = deque()
+        queue.append(item)
+        self._depths[priority] += 1
+        self._wake()
+        return evicted
+
+    def _evict_low(self):
+        queues = self._levels[PRIORITY_LOW]
+        key = max(queues, key=lambda k: len(queues[k]))
+        item = queues[key].pop()
+        if not queues[key]:
+            del queues[key]
+        self._depths[PRIORITY_LOW] -= 1
+        return item
+
+    def _wake(self) -> None:
+        while self._getters:
+            getter = self._getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                return
+
+    def get_nowait(self):
+        for priority, queues in enumerate(self._levels):
+            if not queues:
+                continue
+            key = next(iter(queues))
+            queue = queues[key]
+            item = queue.popleft()
+            self._depths[priority] -= 1
+            if queue:
+                # Turn over: next guild
+                queues.move_to_end(key)
+            else:
+                del queues[key]
+            return item
+        raise asyncio.QueueEmpty
+
+    async def get(self):
+        while self.empty():
+            getter = asyncio.get_running_loop().create_future()
+            self._getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                getter.cancel()
+                # Pass the wake-up on if we were woken and cancelled at the same time
+                if not self.empty():
+                    self._wake()
+                raise
+        return self.get_nowait()
+
+    def task_done(self) -> None:
+        pass
@@ -0,0 +1,156 @@
+"""Fast local token estimates and a token-budgeted conversation context.
+
+Estimates are a character heuristic (about 4 ASCII characters per token, one token
+per other character) scaled by a ratio learned from the token counts Gemini reports,
+so they need no tokenizer and cost next to nothing per message.
+"""
+import math
+import os
+from typing import Callable, Dict, List, Optional, Sequence
+
+# Max estimated tokens of recent conversation in a prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+# Longer messages are cut to about this many tokens
+CONTEXT_LINE_TOKENS = int(os.getenv("CONTEXT_LINE_TOKENS", "200"))
+# Gemini counts an image as a fixed 258 tokens (larger ones are tiled, so this is a floor)
+IMAGE_TOKENS = 258
+# Media URLs shown per context line
+_MAX_LINE_URLS = 2
+# The newest lines are kept before mentions/replies get priority, so the reply still follows the chat
+_KEEP_NEWEST = 2
+# A line cut to fit the budget keeps at least this many tokens, or is dropped
+_MIN_LINE_TOKENS = 16
+# Room for elide()'s "…[N more chars]" marker and the line break
+_ELISION_TOKENS = 8
+
+
+def raw_estimate(text: str) -> int:
+    if not text:
+        return 0
+    if text.isascii():
+        return (len(text) + 3) // 4
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return (ascii_chars + 3) // 4 + len(text) - ascii_chars
+
+
+class TokenEstimator:
+    """Heuristic token counts, calibrated against actual prompt sizes."""
+
+    def __init__(self):
+        # actual / raw estimate, smoothed
+        self.ratio = 1.0
+        self.calls = 0
+        self.estimated_total = 0
+        self.actual_total = 0
+
+    def estimate(self, text: str) -> int:
+        return math.ceil(raw_estimate(text) * self.ratio)
+
+    def estimate_messages(self, messages: Sequence) -> int:
+        """Estimated prompt tokens of LangChain messages (text and image parts)."""
+        total = 0
+        for message in messages:
+            content = message.content
+            if isinstance(content, str):
+                total += self.estimate(content)
+                continue
+            for part in content:
+                if isinstance(part, str):
+                    total += self.estimate(part)
+                elif part.get("type") == "text":
+                    total += self.estimate(part.get("text", ""))
+                else:
+                    total += IMAGE_TOKENS
+        return total
+
+    def observe(self, estimated: int, actual: int) -> None:
+        """Record a call's estimated vs reported prompt tokens and nudge the ratio toward the truth."""
+        if estimated <= 0 or actual <= 0:
+            return
+        self.calls += 1
+        self.estimated_total += estimated
+        self.actual_total += actual
+        self.ratio = min(3.0, max(0.5, self.ratio * (1 + 0.1 * (actual / estimated - 1))))
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "calls": self.calls,
+            "ratio": round(self.ratio, 3),
+            "estimated": self.estimated_total,
+            "actual": self.actual_total,
+        }
+
+
+token_estimator = TokenEstimator()
+
+
+def elide(text: str, max_tokens: int) -> str:
+    """Cut `text` to about `max_tokens`, noting how much was left out."""
+    tokens = token_estimator.estimate(text)
+    if tokens <= max_tokens:
+        return text
+    keep = max(1, len(text) * max_tokens // tokens)
+    return f"{text[:keep].rstrip()} …[{len(text) - keep} more chars]"
+
+
+def _line(record, include_media: bool, line_tokens: int) -> str:
+    content = elide(record.content, line_tokens) if record.content else ("(media)" if record.media_urls else "(no text)")
+    if include_media and record.media_urls:
+        urls = " ".join(record.media_urls[:_MAX_LINE_URLS])
+        if len(record.media_urls) > _MAX_LINE_URLS:
+            urls += f" +{len(record.media_urls) - _MAX_LINE_URLS} more"
+        content = f"{content} [media: {urls}]"
+    return f"{record.author}: {content}"
+
+
+def budget_context_lines(
+    records: List,
+    include_media: bool = True,
+    budget: Optional[int] = None,
+    priority: Optional[Callable[[object], bool]] = None,
+    line_tokens: int = CONTEXT_LINE_TOKENS,
+) -> List[str]:
+    """Context lines for `records` (oldest first) that fit in `budget` estimated tokens.
+
+    Long messages are elided first. If the lines still don't fit, the newest few are kept,
+    then lines where `priority(record)` is true (mentions of and replies to the bot), then
+    the rest newest first. The rest stop at the first line that doesn't fit, which is cut
+    to the budget left, so the lines dropped are the oldest ones and no gaps open up in
+    the recent conversation. Kept lines stay in order.
+    """
+    lines = [_line(r, include_media, line_tokens) for r in records]
+    if budget is None:
+        return lines
+    costs = [token_estimator.estimate(line) + 1 for line in lines]
+    if sum(costs) <= budget:
+        return lines
+    newest_first = list(range(len(lines) - 1, -1, -1))
+    order = newest_first[:_KEEP_NEWEST]
+    rest = newest_first[_KEEP_NEWEST:]
+    prioritized = set()
+    if priority is not None:
+        prioritized = {i for i in rest if priority(records[i])}
+        order += [i for i in rest if i in prioritized] + [i for i in rest if i not in prioritized]
+    else:
+        order += rest
+    kept: Dict[int, str] = {}
+    used = 0
+    contiguous = True
+    for i in order:
+        if i not in prioritized and not contiguous:
+            continue
+        if used + costs[i] <= budget:
+            kept[i] = lines[i]
+            used += costs[i]
+        elif i not in prioritized:
+            # Cut this line to what's left and drop everything older
+            contiguous = False
+            remaining = budget - used - _ELISION_TOKENS
+            if remaining >= _MIN_LINE_TOKENS:
+                kept[i] = elide(lines[i], remaining)
+                used += token_estimator.estimate(kept[i]) + 1
+    dropped = len(lines) - len(kept)
+    selected = [kept[i] for i in sorted(kept)]
+    if dropped:
+        selected.insert(0, f"({dropped} message{'s' if dropped != 1 else ''} not shown)")
+    return selected
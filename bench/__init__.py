@@ -0,0 +1 @@
+"""Offline benchmark and trace-replay harness for the message pipeline (see bench/run.py)."""
@@ -0,0 +1,76 @@
+"""Regression check: a busy channel must not postpone its reply forever.
+
+Drives ReplyCoalescer with a fake handler that takes `--generation` seconds before it
+commits, while a message arrives every `--interval` seconds (each one a trigger). Every
+message cancels the uncommitted generation, so without a hard deadline no reply would
+ever be sent. Fails (exit 1) unless replies keep coming at least every
+`max_wait + quiet window + generation` seconds.
+
+    python -m bench.coalesce_check
+    python -m bench.coalesce_check --interval 0.2 --generation 2 --duration 20
+"""
+import argparse
+import asyncio
+import sys
+import time
+from typing import List, Optional
+
+from coalesce import MENTION, ReplyCoalescer
+
+
+class _Message:
+    def __init__(self, message_id: int, channel_id: int):
+        self.id = message_id
+        self.channel_id = channel_id
+
+
+async def run(args) -> dict:
+    sent: List[float] = []
+    generations = 0
+
+    async def handler(message, triggers):
+        nonlocal generations
+        generations += 1
+        await asyncio.sleep(args.generation)
+        coalescer.commit(message.channel_id)
+        sent.append(time.monotonic())
+
+    coalescer = ReplyCoalescer(handler, quiet_window=args.quiet_window, max_wait=args.max_wait)
+    start = time.monotonic()
+    message_id = 0
+    while time.monotonic() - start < args.duration:
+        message_id += 1
+        coalescer.trigger(1, _Message(message_id, 1), {MENTION})
+        await asyncio.sleep(args.interval)
+    end = time.monotonic()
+    gaps = [b - a for a, b in zip([start] + sent, sent + [end])]
+    return {
+        "messages": message_id,
+        "replies": len(sent),
+        "generations": generations,
+        "cancelled": coalescer.stale_cancelled,
+        "max_gap": round(max(gaps), 2),
+        "allowed_gap": round(args.max_wait + args.quiet_window + args.generation, 2),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Check that REPLY_MAX_WAIT bounds reply delay in a busy channel")
+    parser.add_argument("--interval", type=float, default=0.5, help="seconds between messages")
+    parser.add_argument("--generation", type=float, default=3.0, help="seconds a reply takes before it commits")
+    parser.add_argument("--quiet-window", type=float, default=1.5)
+    parser.add_argument("--max-wait", type=float, default=4.0)
+    parser.add_argument("--duration", type=float, default=30.0)
+    args = parser.parse_args(argv)
+    report = asyncio.run(run(args))
+    for key, value in report.items():
+        print(f"{key:<14} {value}")
+    # The last gap may be cut short by the end of the run, so only check it's not exceeded
+    if not report["replies"] or report["max_gap"] > report["allowed_gap"] + 0.5:
+        print("FAIL: replies were postponed past the max wait")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Fake Discord objects, webhook and LLM for driving bot.on_message offline."""
+import asyncio
+import itertools
+import random
+import re
+import time
+from typing import Callable, Dict, List, Optional
+
+# Snowflake-like ids: increasing, so buffers keep their order
+_ids = itertools.count(1_000_000_000_000_000_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.id = next_id()
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeGuild:
+    def __init__(self, name: str):
+        self.id = next_id()
+        self.name = name
+
+
+class FakeAttachment:
+    def __init__(self, url: str):
+        self.url = url
+
+
+class FakeReference:
+    def __init__(self, message_id: int):
+        self.message_id = message_id
+        self.resolved = None
+
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str, attachments=None, reference=None, webhook_id=None):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.attachments: List[FakeAttachment] = attachments or []
+        self.embeds: List = []
+        self.stickers: List = []
+        self.reference: Optional[FakeReference] = reference
+        self.webhook_id = webhook_id
+
+
+class FakeChannel:
+    """Text channel with simulated REST latency for history backfills."""
+
+    def __init__(self, guild: FakeGuild, name: str, rest_latency: float = 0.08):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.rest_latency = rest_latency
+        self.messages: List[FakeMessage] = []
+        self.rest_calls = 0
+
+    async def history(self, limit: int = 100):
+        self.rest_calls += 1
+        await asyncio.sleep(self.rest_latency)
+        for message in reversed(self.messages[-limit:]):
+            yield message
+
+    async def fetch_message(self, message_id: int) -> FakeMessage:
+        self.rest_calls += 1
+        await asyncio.sleep(self.rest_latency)
+        for message in self.messages:
+            if message.id == message_id:
+                return message
+        raise LookupError(message_id)
+
+
+class FakeSentMessage:
+    def __init__(self, message_id: int):
+        self.id = message_id
+
+
+class FakeWebhook:
+    """Records sends with simulated latency and echoes them back as channel messages, like Discord does."""
+
+    def __init__(self, webhook_id: int, channel: FakeChannel, latency: float, on_send: Callable[["FakeWebhook", str, FakeMessage], None]):
+        self.id = webhook_id
+        self.channel = channel
+        self.latency = latency
+        self.on_send = on_send
+        self.user = FakeUser("webhook", bot=True)
+
+    async def send(self, content: str, username: Optional[str] = None, avatar_url: Optional[str] = None, wait: bool = False):
+        await asyncio.sleep(self.latency)
+        echo = FakeMessage(self.channel, self.user, content, webhook_id=self.id)
+        self.channel.messages.append(echo)
+        self.on_send(self, content, echo)
+        return FakeSentMessage(echo.id)
+
+    async def delete(self):
+        pass
+
+
+class StubFailure(Exception):
+    pass
+
+
+class _Chunk:
+    def __init__(self, content: str, usage_metadata: Optional[dict] = None):
+        self.content = content
+        self.usage_metadata = usage_metadata
+
+
+# Fake messages carry their id as "[#<id>]" so replies can be matched to what they answer
+TAG_RE = re.compile(r"\[#(\d+)\]")
+
+
+class StubLLM:
+    """Stands in for the chat model: lognormal latency, configurable failure and hang rates.
+
+    Replies start with the tag of the message they answer and have `parts` ||| segments.
+    """
+
+    def __init__(self, latency: float = 1.0, sigma: float = 0.4, failure_rate: float = 0.0, hang_rate: float = 0.0, hang_seconds: float = 120.0, parts: int = 2):
+        self.latency = latency
+        self.sigma = sigma
+        self.failure_rate = failure_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+        self.parts = parts
+        self.calls = 0
+        self.failures = 0
+
+    def _reply(self, messages) -> str:
+        text = messages[-1].content
+        if isinstance(text, list):
+            text = " ".join(p.get("text", "") for p in text if isinstance(p, dict))
+        # The message being answered comes last in the turn, after the context
+        tags = TAG_RE.findall(text or "")
+        tag = f"[#{tags[-1]}]" if tags else "[#?]"
+        return " ||| ".join([tag] + ["lol ok"] * (self.parts - 1))
+
+    async def _wait(self) -> None:
+        self.calls += 1
+        roll = random.random()
+        if roll < self.hang_rate:
+            await asyncio.sleep(self.hang_seconds)
+        elif roll < self.hang_rate + self.failure_rate:
+            await asyncio.sleep(random.lognormvariate(0, self.sigma) * self.latency * 0.2)
+            self.failures += 1
+            raise StubFailure("stub model failure")
+
+    def _usage(self, messages, reply: str) -> dict:
+        prompt = sum(len(str(m.content)) for m in messages) // 4
+        output = len(reply) // 4
+        return {"input_tokens": prompt, "output_tokens": output, "total_tokens": prompt + output}
+
+    async def ainvoke(self, messages, **kwargs):
+        await self._wait()
+        await asyncio.sleep(random.lognormvariate(0, self.sigma) * self.latency)
+        reply = self._reply(messages)
+        return _Chunk(reply, self._usage(messages, reply))
+
+    async def astream(self, messages, **kwargs):
+        await self._wait()
+        total = random.lognormvariate(0, self.sigma) * self.latency
+        segments = self._reply(messages).split(" ||| ")
+        for i, segment in enumerate(segments):
+            await asyncio.sleep(total / len(segments))
+            yield _Chunk(segment if i == 0 else f" ||| {segment}")
+        reply = " ||| ".join(segments)
+        yield _Chunk("", self._usage(messages, reply))
+
+
+class LoopLagMonitor:
+    """Measures event-loop lag: how late a periodic wake-up actually runs."""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+
+
+def fake_media_fetcher(fixtures: Dict[str, bytes], latency: float = 0.03):
+    """A MediaPipeline fetcher serving fixture bytes by URL."""
+    async def fetch(url: str):
+        await asyncio.sleep(latency)
+        if url not in fixtures:
+            raise LookupError(url)
+        return fixtures[url], "image/png"
+    return fetch
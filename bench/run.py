@@ -0,0 +1,259 @@
+"""Offline load test and trace replay of the on_message pipeline.
+
+Drives the real bot.on_message -> coalescer -> context build -> media -> LLM engine ->
+webhook delivery path with fake guilds/channels/webhooks and a stub LLM, then reports
+throughput, end-to-end reply latency (message received -> first reply part sent) and
+event-loop lag.
+
+    python -m bench.run --guilds 50 --rate 20 --duration 30
+    python -m bench.run --guilds 200 --rate 100 --llm-latency 2 --failure-rate 0.05 --json
+    python -m bench.run --replay trace.jsonl --speed 4
+
+Pipeline settings (LLM_CONCURRENCY, REPLY_QUIET_WINDOW, ...) come from the environment as usual.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional
+
+from bench.fakes import (
+    FakeAttachment,
+    FakeChannel,
+    FakeGuild,
+    FakeMessage,
+    FakeReference,
+    FakeUser,
+    FakeWebhook,
+    LoopLagMonitor,
+    StubLLM,
+    TAG_RE,
+    fake_media_fetcher,
+    next_id,
+)
+from bench.trace import load_trace
+
+BOT_NAME = "Yuuki"
+_WORDS = ["lol", "ok", "wait", "what", "no", "yeah", "true", "bro", "same", "idk", "fr", "nah"]
+
+
+def _png(width: int, height: int) -> bytes:
+    """A tiny valid PNG, used as media fixture."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    raw = b"".join(b"\x00" + b"\x80" * width * 3 for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw)) + chunk(b"IEND", b""))
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class Harness:
+    def __init__(self, args):
+        import bot as bot_module
+        import store
+        from ai import gemini
+        from ai.media import media_pipeline
+        from ai.router import MODEL_FAST, model_router
+        from delivery import delivery
+
+        self.args = args
+        self.bot = bot_module
+        self.store = store
+        self.llm = StubLLM(args.llm_latency, args.llm_sigma, args.failure_rate, args.hang_rate, parts=args.parts)
+        self.fast_llm = StubLLM(args.fast_llm_latency, args.llm_sigma, args.failure_rate, args.hang_rate, parts=args.parts)
+        model_router.factory = lambda model: self.fast_llm if model == MODEL_FAST else self.llm
+        gemini._llms[(gemini.SUMMARY_MODEL, 0.2)] = self.fast_llm
+        delivery.webhook_factory = self._make_webhook
+        self.fixtures = {f"https://media.invalid/{i}.png": _png(64 + i, 64 + i) for i in range(args.media_pool)}
+        media_pipeline.fetcher = fake_media_fetcher(self.fixtures)
+
+        self.channels: List[FakeChannel] = []
+        self.authors: Dict[int, List[FakeUser]] = {}
+        self._channel_by_webhook: Dict[int, FakeChannel] = {}
+        self._last_bot_message: Dict[int, int] = {}
+        self._dispatched_at: Dict[int, float] = {}
+        self._answered = set()
+        self.latencies: List[float] = []
+        self.messages = 0
+        self.webhook_sends = 0
+        self.lag = LoopLagMonitor()
+
+    def add_guild(self, name: str) -> FakeChannel:
+        guild = FakeGuild(name)
+        channel = FakeChannel(guild, "general", rest_latency=self.args.rest_latency)
+        webhook_id = next_id()
+        self._channel_by_webhook[webhook_id] = channel
+        config = self.store.set_channel(guild.id, channel.id, webhook_id, "token")
+        config.name = BOT_NAME
+        self.channels.append(channel)
+        self.authors[channel.id] = [FakeUser(f"user{i}") for i in range(5)]
+        return channel
+
+    def _make_webhook(self, webhook_id: int, token: str) -> FakeWebhook:
+        return FakeWebhook(webhook_id, self._channel_by_webhook[webhook_id], self.args.webhook_latency, self._on_send)
+
+    def _on_send(self, webhook: FakeWebhook, content: str, echo: FakeMessage) -> None:
+        self.webhook_sends += 1
+        match = TAG_RE.search(content)
+        if match:
+            answered = int(match.group(1))
+            if answered in self._dispatched_at and answered not in self._answered:
+                self._answered.add(answered)
+                self.latencies.append(time.perf_counter() - self._dispatched_at[answered])
+        self._last_bot_message[webhook.channel.id] = echo.id
+        # Discord echoes webhook messages back through the gateway
+        asyncio.ensure_future(self.bot.on_message(echo))
+
+    def dispatch(self, channel: FakeChannel, author: FakeUser, length: int, mentions_name: bool, reply_to_bot: bool, media: int) -> None:
+        reference = None
+        if reply_to_bot and channel.id in self._last_bot_message:
+            reference = FakeReference(self._last_bot_message[channel.id])
+        attachments = [FakeAttachment(random.choice(list(self.fixtures))) for _ in range(media)] if self.fixtures else []
+        message = FakeMessage(channel, author, "", attachments=attachments, reference=reference)
+        words = []
+        while sum(len(w) + 1 for w in words) < length:
+            words.append(random.choice(_WORDS))
+        if mentions_name:
+            words.insert(random.randrange(len(words) + 1), BOT_NAME.lower())
+        message.content = f"[#{message.id}] " + " ".join(words)
+        channel.messages.append(message)
+        self.messages += 1
+        self._dispatched_at[message.id] = time.perf_counter()
+        asyncio.ensure_future(self.bot.on_message(message))
+
+    async def run_synthetic(self) -> float:
+        args = self.args
+        for i in range(args.guilds):
+            self.add_guild(f"guild{i}")
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            await asyncio.sleep(random.expovariate(args.rate))
+            channel = random.choice(self.channels)
+            self.dispatch(
+                channel,
+                random.choice(self.authors[channel.id]),
+                length=int(random.expovariate(1 / 40)) + 1,
+                mentions_name=random.random() < args.mention_rate,
+                reply_to_bot=random.random() < args.reply_rate,
+                media=1 if random.random() < args.media_rate else 0,
+            )
+        return time.perf_counter() - start
+
+    async def run_replay(self) -> float:
+        events = load_trace(self.args.replay)
+        channels: Dict[str, FakeChannel] = {}
+        authors: Dict[str, FakeUser] = {}
+        start = time.perf_counter()
+        for event in events:
+            delay = event.t / self.args.speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            channel = channels.get(event.channel)
+            if channel is None:
+                channel = channels[event.channel] = self.add_guild(event.guild)
+            author = authors.get(event.author)
+            if author is None:
+                author = authors[event.author] = FakeUser(f"user{len(authors)}")
+            self.dispatch(channel, author, event.length, event.mentions_name, event.reply_to_bot, min(event.media, 1))
+        return time.perf_counter() - start
+
+    async def run(self) -> dict:
+        self.lag.start()
+        elapsed = await (self.run_replay() if self.args.replay else self.run_synthetic())
+        # Let in-flight replies finish
+        deadline = time.perf_counter() + self.args.drain
+        from ai.engine import engine
+        while time.perf_counter() < deadline:
+            coalescer = self.bot.reply_coalescer.stats()
+            if not (engine.stats()["queued"] or engine.stats()["in_flight"] or coalescer["pending"] or coalescer["running"]):
+                break
+            await asyncio.sleep(0.1)
+        self.lag.stop()
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        from ai.engine import engine
+        from ai.media import media_pipeline
+        from ai.router import model_router
+        from delivery import delivery
+
+        return {
+            "guilds": len(self.channels),
+            "seconds": round(elapsed, 2),
+            "messages": self.messages,
+            "messages_per_sec": round(self.messages / elapsed, 2) if elapsed else 0.0,
+            "llm_calls": self.llm.calls,
+            "fast_llm_calls": self.fast_llm.calls,
+            "replies_answered": len(self.latencies),
+            "webhook_sends": self.webhook_sends,
+            "replies_per_sec": round(len(self.latencies) / elapsed, 2) if elapsed else 0.0,
+            "latency_p50": round(percentile(self.latencies, 0.50), 3),
+            "latency_p95": round(percentile(self.latencies, 0.95), 3),
+            "latency_p99": round(percentile(self.latencies, 0.99), 3),
+            "loop_lag_p50_ms": round(percentile(self.lag.samples, 0.50) * 1000, 2),
+            "loop_lag_p99_ms": round(percentile(self.lag.samples, 0.99) * 1000, 2),
+            "loop_lag_max_ms": round(max(self.lag.samples, default=0.0) * 1000, 2),
+            "rest_calls": sum(c.rest_calls for c in self.channels),
+            "engine": engine.stats(),
+            "router": model_router.stats(),
+            "coalescer": self.bot.reply_coalescer.stats(),
+            "delivery": delivery.stats(),
+            "media": media_pipeline.stats(),
+            "memory": self.bot.channel_memory.stats(),
+        }
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Offline load test of the on_message pipeline")
+    parser.add_argument("--guilds", type=int, default=20, help="watched guilds (synthetic mode)")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages/sec across all guilds")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    parser.add_argument("--replay", help="replay an anonymized trace instead of synthetic load")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed-up factor")
+    parser.add_argument("--mention-rate", type=float, default=0.2)
+    parser.add_argument("--reply-rate", type=float, default=0.1)
+    parser.add_argument("--media-rate", type=float, default=0.05)
+    parser.add_argument("--media-pool", type=int, default=20, help="distinct media fixtures")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="median stub LLM latency (s)")
+    parser.add_argument("--fast-llm-latency", type=float, default=0.5, help="median latency of the fast-tier stub (s)")
+    parser.add_argument("--llm-sigma", type=float, default=0.4, help="lognormal sigma of LLM latency")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of LLM calls that fail")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="fraction of LLM calls that hang until timeout")
+    parser.add_argument("--parts", type=int, default=2, help="||| segments per reply")
+    parser.add_argument("--webhook-latency", type=float, default=0.1)
+    parser.add_argument("--rest-latency", type=float, default=0.08)
+    parser.add_argument("--drain", type=float, default=30.0, help="max seconds to wait for in-flight replies")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's own logging")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    # Nothing is persisted or fetched for real
+    os.environ.setdefault("CONFIG_JOURNAL_PATH", os.devnull)
+    with open(os.devnull, "w") as devnull, (contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(devnull)):
+        report = asyncio.run(Harness(args).run())
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in report.items():
+        print(f"{key:<20} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""Record anonymized message-event traces from a live bot and load them for replay.
+
+A trace is JSON lines, one per message in a watched channel. Ids are replaced by
+salted hashes and content by its length, so traces can be shared safely:
+
+    {"t": 12.31, "guild": "9f2c...", "channel": "51ab...", "author": "0c7e...",
+     "length": 42, "mentions_name": false, "reply_to_bot": true, "media": 1}
+
+Set TRACE_RECORD_PATH to record from bot.py; replay with `python -m bench.run --replay <path>`.
+"""
+import hashlib
+import json
+import os
+import time
+from typing import Iterator, List, NamedTuple
+
+
+class TraceEvent(NamedTuple):
+    t: float
+    guild: str
+    channel: str
+    author: str
+    length: int
+    mentions_name: bool
+    reply_to_bot: bool
+    media: int
+
+
+class TraceRecorder:
+    def __init__(self, path: str, salt: str = ""):
+        self.path = path
+        self.salt = salt or os.urandom(8).hex()
+        self._start = time.monotonic()
+        self._file = open(path, "a", encoding="utf-8")
+
+    def _anon(self, value) -> str:
+        return hashlib.sha256(f"{self.salt}:{value}".encode()).hexdigest()[:12]
+
+    def record(self, message, mentions_name: bool, reply_to_bot: bool) -> None:
+        media = len(message.attachments) + len(message.embeds) + len(getattr(message, "stickers", []))
+        event = TraceEvent(
+            t=round(time.monotonic() - self._start, 3),
+            guild=self._anon(message.guild.id),
+            channel=self._anon(message.channel.id),
+            author=self._anon(message.author.id),
+            length=len(message.content or ""),
+            mentions_name=bool(mentions_name),
+            reply_to_bot=bool(reply_to_bot),
+            media=media,
+        )
+        self._file.write(json.dumps(event._asdict()) + "\n")
+        self._file.flush()
+
+
+def read_trace(path: str) -> Iterator[TraceEvent]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield TraceEvent(**json.loads(line))
+
+
+def load_trace(path: str) -> List[TraceEvent]:
+    return sorted(read_trace(path), key=lambda e: e.t)
@@ -1,139 +1,443 @@
 import asyncio
+import functools
 import os
 import random
-from concurrent.futures import ThreadPoolExecutor
-from typing import List
+import signal
+import time
+from typing import List, Set
 
 import discord
 from dotenv import load_dotenv
 from discord.ext import commands
 
-from store import (
-    watched_channels,
-    webhook_by_server,
-    webhook_name_by_server,
-    webhook_avatar_by_server,
-    personality_by_server,
-    enabled_by_server,
-    load_watched_channels,
-)
+from store import watched_by_channel, get_server, load_servers, remove_server, unwatch_listeners
 from ai.gemini import (
     get_media_urls_from_message,
     build_context_from_messages,
     get_gemini_reply,
+    stream_gemini_reply,
+    split_reply,
     strip_custom_emojis,
+    warm_up,
 )
+from ai.media import media_pipeline
+from ai.memory import ConversationMemory
+from ai.engine import engine as llm_engine, LLMQueueFull
+from ai.router import model_router
+from ai.prefix import prompt_prefixes
+from ai.tokens import CONTEXT_TOKEN_BUDGET, elide, token_estimator
+from ai.scheduler import PRIORITY_HIGH, PRIORITY_LOW
 from commands.server import setup as setup_server_commands
+from commands.admin import setup as setup_admin_commands
+from coalesce import ReplyCoalescer, MENTION, REPLY, CHANCE
+from persistence import config_writer
+from sync import CONFIG_SYNC_INTERVAL, config_sync
+from metrics import (
+    METRICS_PORT,
+    messages_total,
+    record_usage,
+    register_stats,
+    replies_total,
+    stage_seconds,
+    start_metrics_server,
+)
+from message_index import message_index
+from delivery import delivery as webhook_delivery
+from cluster import shard_for
+from conversation import get_recent_messages, record_message, apply_edit, remove_messages, forget_channel
+from snapshot import SNAPSHOT_INTERVAL, Snapshotter
 
 load_dotenv()
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.messages = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Set by cluster.py: this process runs only these gateway shards and their guilds
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0"))
+SHARD_IDS = [int(s) for s in os.getenv("SHARD_IDS", "").split(",") if s]
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="!", intents=intents, shard_ids=SHARD_IDS or None, shard_count=SHARD_COUNT)
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents)
+webhook_delivery.bind(bot)
 
 REPLY_CHANCE = 0.25
 CONTEXT_MESSAGE_COUNT = 10
-_executor = ThreadPoolExecutor(max_workers=2)
+channel_memory = ConversationMemory(CONTEXT_MESSAGE_COUNT, on_usage=record_usage)
+# A channel the server stops watching starts from scratch (backfill, no summary) if it is ever watched again
+unwatch_listeners.append(forget_channel)
+unwatch_listeners.append(channel_memory.forget)
+# Send each ||| segment as soon as the model finishes it instead of waiting for the full reply
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") != "0"
+_started = False
+
+# Record an anonymized message-event trace for offline replay (see bench/)
+TRACE_RECORD_PATH = os.getenv("TRACE_RECORD_PATH")
+trace_recorder = None
+if TRACE_RECORD_PATH:
+    from bench.trace import TraceRecorder
+    trace_recorder = TraceRecorder(TRACE_RECORD_PATH)
 
 
 @bot.event
 async def on_ready():
+    global _started
     print(f'{bot.user} has logged in!')
+    if _started:
+        # on_ready fires again after every gateway reconnect; commands and state are already in place
+        return
+    _started = True
+    # Commands are global; in cluster mode only the process running shard 0 syncs them
+    if not SHARD_IDS or 0 in SHARD_IDS:
+        try:
+            synced = await bot.tree.sync()
+            print(f'Synced {len(synced)} command(s)')
+        except Exception as e:
+            print(f'Failed to sync commands: {e}')
+
+    # Changes journaled but not yet written to Supabase are newer than the table
+    replayed = config_writer.restore()
+    if replayed:
+        print(f'Replayed {replayed} unsaved config change(s) from the local journal')
+    if CONFIG_SYNC_INTERVAL:
+        # First sync is the full load; later ones pick up rows changed elsewhere
+        config_sync.pending = config_writer.pending
+        config_sync.owns = owns_guild
+        config_sync.loaded = _drop_stale_restored
+        config_sync.start()
+    else:
+        asyncio.ensure_future(_load_servers())
+    if SNAPSHOT_INTERVAL:
+        # Restored buffers and triggers were as of the last snapshot; catch up with Discord
+        asyncio.ensure_future(snapshotter.revalidate(bot))
+        snapshotter.start()
+    asyncio.ensure_future(_warm_up_llm())
+    if METRICS_PORT:
+        try:
+            await start_metrics_server(int(METRICS_PORT))
+        except Exception as e:
+            print(f'Failed to start metrics server: {e}')
+
+
+async def _restore_snapshot() -> None:
+    """Runs before the gateway connects, so the first messages after a restart already have context."""
+    if SNAPSHOT_INTERVAL:
+        snapshotter.restore()
+    # Stop on SIGTERM like on Ctrl+C: through bot.close(), so the final snapshot is written
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+
+
+bot.setup_hook = _restore_snapshot
+_close_bot = bot.close
+_snapshot_saved = False
+
+
+async def _close_with_snapshot() -> None:
+    """Final snapshot at shutdown, taken before disconnecting while in-flight replies are still tracked."""
+    global _snapshot_saved
+    if SNAPSHOT_INTERVAL and not _snapshot_saved:
+        _snapshot_saved = True
+        try:
+            written = snapshotter.save()
+            print(f'Saved snapshot ({written} bytes) to {snapshotter.path}')
+        except Exception as e:
+            print(f'Failed to save snapshot: {e}')
+    await _close_bot()
+
+
+bot.close = _close_with_snapshot
+
+
+async def _warm_up_llm() -> None:
+    """Import the Gemini SDK and build its client off the event loop, before the first reply needs it."""
     try:
-        synced = await bot.tree.sync()
-        print(f'Synced {len(synced)} command(s)')
+        await asyncio.to_thread(warm_up)
     except Exception as e:
-        print(f'Failed to sync commands: {e}')
+        print(f'Failed to warm up Gemini client: {e}')
+
+
+def owns_guild(server_id: int) -> bool:
+    """Whether this process's shards receive the guild's events (always true outside cluster mode)."""
+    return not SHARD_IDS or shard_for(server_id, SHARD_COUNT) in SHARD_IDS
+
+
+async def _load_servers() -> None:
+    """Fill the store from Supabase in the background while messages are already being served.
+
+    Retries with backoff until the whole table has been read once.
+    """
+    seen = set()
+    backoff = 0.0
+    while True:
+        try:
+            loaded = await load_servers(pending=config_writer.pending, owns=owns_guild, seen=seen)
+            break
+        except Exception as e:
+            backoff = min(max(backoff * 2, 5.0), 300.0)
+            print(f'Failed to load watched channels, retrying in {backoff:.0f}s: {e}')
+            await asyncio.sleep(backoff)
+    stale = _drop_stale_restored(seen)
+    print(f'Loaded {loaded} server(s), {len(watched_by_channel)} watched channel(s) from database'
+          + (f', dropped {len(stale)} deleted server(s) restored from the snapshot' if stale else ''))
+
+
+def _drop_stale_restored(seen: Set[int]) -> List[int]:
+    """After a full load, remove servers restored from a snapshot whose rows have since been deleted.
+
+    `seen` are the ids the load read; servers changed here since are kept.
+    """
+    stale = [sid for sid in snapshotter.restored_server_ids if sid not in seen and not config_writer.pending(sid)]
+    for server_id in stale:
+        remove_server(server_id)
+    snapshotter.restored_server_ids = set()
+    return stale
+
+
+@bot.event
+async def on_raw_message_edit(payload):
+    """Keep the conversation buffer in sync with edits."""
+    if payload.channel_id in watched_by_channel:
+        apply_edit(payload.channel_id, payload.message_id, payload.data)
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    """Drop deleted messages from the conversation buffer."""
+    if payload.channel_id in watched_by_channel:
+        remove_messages(payload.channel_id, [payload.message_id])
+        channel_memory.remove_messages(payload.channel_id, [payload.message_id])
+
 
-    await load_watched_channels()
-    print(f'Loaded {len(watched_channels)} watched channel(s) from database')
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    if payload.channel_id in watched_by_channel:
+        remove_messages(payload.channel_id, payload.message_ids)
+        channel_memory.remove_messages(payload.channel_id, payload.message_ids)
 
 
 @bot.event
 async def on_message(message):
     """Log messages from watched channels; trigger AI reply via webhook."""
-    if message.guild is None:
+    # Fast reject: almost every message the bot sees is outside a watched channel
+    config = watched_by_channel.get(message.channel.id)
+    if config is None:
         return
 
-    server_id = str(message.guild.id)
-    channel_id = str(message.channel.id)
+    started = time.perf_counter()
+    # Buffer every message (including our own replies) so context never needs a history fetch
+    record = record_message(message)
+    if not config.enabled:
+        messages_total.inc(guild=config.server_id, outcome="disabled")
+        return
+    # Messages older than the reply context roll into the channel's running summary
+    channel_memory.observe(config.server_id, message.channel.id, record, config.reply_name)
+    # Ignore this bot's own messages (and its webhook) so it doesn't reply to itself
+    if message.author == bot.user or message.webhook_id == config.webhook_id:
+        message_index.add_bot(message.channel.id, message.id)
+        messages_total.inc(guild=config.server_id, outcome="own")
+        return
+    message_index.add_non_bot(message.channel.id, message.id)
+    print(f'[{message.guild.name} | #{message.channel.name}] {message.author.name}: {message.content}')
 
-    if server_id in watched_channels and watched_channels[server_id] == channel_id:
-        if not enabled_by_server.get(server_id, True):
-            return
-        # Ignore this bot's own messages (and its webhook) so it doesn't reply to itself
-        if message.author == bot.user:
-            return
-        if server_id in webhook_by_server:
-            wh_id, _ = webhook_by_server[server_id]
-            if getattr(message, 'webhook_id', None) == int(wh_id):
-                return
-        print(f'[{message.guild.name} | #{message.channel.name}] {message.author.name}: {message.content}')
-
-        reply_name = webhook_name_by_server.get(server_id) or "Untitled"
-        content_lower = (message.content or "").strip().lower()
-        mentioned_by_name = reply_name and reply_name.strip().lower() in content_lower
-
-        # Reply if this message is a reply to something the bot/webhook sent
-        is_reply_to_bot = False
-        if message.reference and message.reference.message_id:
-            ref = message.reference.resolved
-            if ref is None:
-                try:
-                    ref = await message.channel.fetch_message(message.reference.message_id)
-                except Exception:
-                    ref = None
-            if ref is not None:
-                if server_id in webhook_by_server:
-                    wh_id, _ = webhook_by_server[server_id]
-                    if getattr(ref, "webhook_id", None) is not None and ref.webhook_id == int(wh_id):
-                        is_reply_to_bot = True
-                if ref.author == bot.user:
-                    is_reply_to_bot = True
-
-        should_reply = mentioned_by_name or is_reply_to_bot or random.random() < REPLY_CHANCE
-
-        if should_reply:
+    content_lower = (message.content or "").strip().lower()
+    mentioned_by_name = config.reply_name.strip().lower() in content_lower
+
+    # Reply if this message is a reply to something the bot/webhook sent
+    is_reply_to_bot = await _is_reply_to_bot(message, config)
+
+    if trace_recorder is not None:
+        trace_recorder.record(message, mentioned_by_name, is_reply_to_bot)
+
+    triggers = set()
+    if mentioned_by_name:
+        triggers.add(MENTION)
+    if is_reply_to_bot:
+        triggers.add(REPLY)
+    # Random replies back off as the LLM gets busy so direct interactions stay responsive
+    if not triggers and random.random() < llm_engine.effective_reply_chance(REPLY_CHANCE):
+        triggers.add(CHANCE)
+
+    if triggers:
+        reply_coalescer.trigger(message.channel.id, message, triggers)
+    else:
+        reply_coalescer.note_activity(message.channel.id, message)
+    outcome = "triggered" if triggers else "ignored"
+    messages_total.inc(guild=config.server_id, outcome=outcome)
+    stage_seconds.observe(time.perf_counter() - started, stage="trigger", guild=config.server_id, outcome=outcome)
+
+
+async def _is_reply_to_bot(message, config) -> bool:
+    """Whether `message` replies to something our webhook or bot user sent, answered locally when possible."""
+    if not (message.reference and message.reference.message_id):
+        return False
+    ref_id = message.reference.message_id
+    ref = message.reference.resolved
+    if ref is None:
+        known = message_index.lookup(message.channel.id, ref_id)
+        if known is not None:
+            return known
+        # Only messages from before we started watching end up here
+        with stage_seconds.time(stage="reference_fetch", guild=config.server_id) as labels:
             try:
-                # Previous messages only (exclude current — that's the one we're replying to)
-                history: List = []
-                async for msg in message.channel.history(limit=CONTEXT_MESSAGE_COUNT + 1):
-                    if msg.id != message.id:
-                        history.append(msg)
-                history.reverse()
-                additional_context = build_context_from_messages(history, include_media=False)
-                print(f"Additional context: {additional_context}")
-
-                user_content = strip_custom_emojis((message.content or "").strip()) or "(no text)"
-                media_urls = get_media_urls_from_message(message)
-                if media_urls:
-                    print(f"Media URLs: {media_urls}")
-                reply_name = webhook_name_by_server.get(server_id) or "Untitled"
-                personality = personality_by_server.get(server_id)
-                reply_text = await asyncio.get_event_loop().run_in_executor(
-                    _executor, get_gemini_reply, user_content, additional_context, media_urls, personality, reply_name
-                )
-                print(f"Reply text: {reply_text}")
-                if reply_text:
-                    parts = [p.strip() for p in reply_text.split("|||") if p.strip()]
-                    if parts and server_id in webhook_by_server:
-                        wh_id, wh_token = webhook_by_server[server_id]
-                        webhook = discord.Webhook.partial(int(wh_id), wh_token, client=bot)
-                        username = webhook_name_by_server.get(server_id)
-                        avatar_url = webhook_avatar_by_server.get(server_id)
-                        for part in parts:
-                            await webhook.send(
-                                content=part,
-                                username=username,
-                                avatar_url=avatar_url,
-                            )
-            except Exception as e:
-                print(f"Error during AI reply: {e}")
+                ref = await message.channel.fetch_message(ref_id)
+            except Exception:
+                labels["outcome"] = "error"
+                return False
+    is_ours = (
+        (getattr(ref, "webhook_id", None) is not None and ref.webhook_id == config.webhook_id)
+        or getattr(ref, "author", None) == bot.user
+    )
+    if is_ours:
+        message_index.add_bot(message.channel.id, ref_id)
+    else:
+        message_index.add_non_bot(message.channel.id, ref_id)
+    return is_ours
+
+
+async def _send_parts(server_id: int, channel_id: int, parts: asyncio.Queue) -> int:
+    """Send reply parts through the server's webhook as they arrive on `parts` (None ends the reply); returns parts sent."""
+    sent_parts = 0
+    while True:
+        part = await parts.get()
+        if part is None:
+            return sent_parts
+        config = get_server(server_id)
+        if config is None or not config.watching:
+            return sent_parts
+        reply_coalescer.commit(channel_id)
+        with stage_seconds.time(stage="webhook_send", guild=server_id):
+            sent = await webhook_delivery.send(
+                config.webhook_id,
+                config.webhook_token,
+                content=part,
+                username=config.name,
+                avatar_url=config.avatar_url,
+            )
+        sent_parts += 1
+        if sent is not None:
+            message_index.add_bot(channel_id, sent.id)
+
+
+def _context_priority(channel_id: int, config):
+    """Context lines worth keeping when the token budget runs out: mentions of the bot and replies to it."""
+    # Same mention test as on_message
+    name = config.reply_name.strip().lower() if config is not None else ""
+
+    def is_direct(record) -> bool:
+        if name and name in record.content.lower():
+            return True
+        # Membership only: lookup() would count these as index hits/misses
+        return record.reply_to is not None and (channel_id, record.reply_to) in message_index.bot
+
+    return is_direct
+
+
+async def generate_reply(message, triggers) -> None:
+    """Generate and send one AI reply to the latest message of a (coalesced) burst."""
+    server_id = message.guild.id
+    parts: asyncio.Queue = asyncio.Queue()
+    sender = asyncio.ensure_future(_send_parts(server_id, message.channel.id, parts))
+    outcome = "sent"
+    try:
+        # Previous messages only (exclude current — that's the one we're replying to)
+        with stage_seconds.time(stage="history", guild=server_id):
+            history = await get_recent_messages(message.channel, CONTEXT_MESSAGE_COUNT, before_id=message.id)
+        with stage_seconds.time(stage="context", guild=server_id):
+            additional_context = build_context_from_messages(
+                history,
+                include_media=False,
+                budget=CONTEXT_TOKEN_BUDGET,
+                priority=_context_priority(message.channel.id, get_server(server_id)),
+            )
+        print(f"Additional context: {additional_context}")
+
+        user_content = elide(strip_custom_emojis((message.content or "").strip()), CONTEXT_TOKEN_BUDGET) or "(no text)"
+        with stage_seconds.time(stage="media", guild=server_id):
+            media_urls = await media_pipeline.prepare(get_media_urls_from_message(message))
+        if media_urls:
+            print(f"Media: {len(media_urls)} item(s)")
+        config = get_server(server_id)
+        if config is None:
+            return
+        reply_name = config.reply_name
+        personality = config.personality
+        summary = channel_memory.summary(message.channel.id)
+        prefix = prompt_prefixes.get(server_id, config.name, personality)
+        reasons = ', '.join(sorted(triggers))
+        direct = bool(triggers & {MENTION, REPLY})
+        priority = PRIORITY_HIGH if direct else PRIORITY_LOW
+        tiers = model_router.route(config.model_tier, direct, bool(media_urls))
+        on_usage = functools.partial(record_usage, server_id)
+        queued_at = time.perf_counter()
+
+        if STREAM_REPLIES:
+            async def stream_job():
+                stage_seconds.observe(time.perf_counter() - queued_at, stage="llm_queue", guild=server_id, outcome="ok")
+                with stage_seconds.time(stage="llm", guild=server_id):
+                    async for segment in stream_gemini_reply(
+                        user_content, additional_context, media_urls, personality, reply_name, on_usage, summary, tiers, prefix
+                    ):
+                        print(f"Reply part ({reasons}): {segment}")
+                        parts.put_nowait(segment)
+
+            await llm_engine.submit(stream_job, priority=priority, key=server_id)
+        else:
+            async def reply_job():
+                stage_seconds.observe(time.perf_counter() - queued_at, stage="llm_queue", guild=server_id, outcome="ok")
+                with stage_seconds.time(stage="llm", guild=server_id):
+                    return await get_gemini_reply(
+                        user_content, additional_context, media_urls, personality, reply_name, on_usage, summary, tiers, prefix
+                    )
+
+            reply_text = await llm_engine.submit(reply_job, priority=priority, key=server_id)
+            print(f"Reply text ({reasons}): {reply_text}")
+            for part in split_reply(reply_text):
+                parts.put_nowait(part)
+    except asyncio.CancelledError:
+        sender.cancel()
+        replies_total.inc(guild=server_id, outcome="cancelled")
+        raise
+    except LLMQueueFull as e:
+        outcome = "dropped"
+        print(f"Skipping AI reply: {e} ({llm_engine.stats()})")
+    except asyncio.TimeoutError:
+        outcome = "timeout"
+        print(f"AI reply timed out ({llm_engine.stats()})")
+    except Exception as e:
+        outcome = "error"
+        print(f"Error during AI reply: {e}")
+    finally:
+        parts.put_nowait(None)
+    try:
+        if not await sender and outcome == "sent":
+            outcome = "empty"
+    except Exception as e:
+        outcome = "send_error"
+        print(f"Error sending AI reply: {e}")
+    replies_total.inc(guild=server_id, outcome=outcome)
+
+
+reply_coalescer = ReplyCoalescer(generate_reply)
+snapshotter = Snapshotter(reply_coalescer, channel_memory, config_sync if CONFIG_SYNC_INTERVAL else None)
 
+register_stats("llm", llm_engine.stats)
+register_stats("router", model_router.stats)
+register_stats("prompt_prefix", prompt_prefixes.stats)
+register_stats("tokens", token_estimator.stats)
+register_stats("coalescer", reply_coalescer.stats)
+register_stats("delivery", webhook_delivery.stats)
+register_stats("media", media_pipeline.stats)
+register_stats("memory", channel_memory.stats)
+register_stats("message_index", message_index.stats)
+register_stats("config_writer", config_writer.stats)
+if CONFIG_SYNC_INTERVAL:
+    register_stats("sync", config_sync.stats)
+if SNAPSHOT_INTERVAL:
+    register_stats("snapshot", snapshotter.stats)
 
 # Register commands
 setup_server_commands(bot)
+setup_admin_commands(bot)
 
 if __name__ == '__main__':
     token = os.getenv('DISCORD_BOT_TOKEN')
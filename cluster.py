@@ -0,0 +1,239 @@
+"""Cluster mode: run the bot as several worker processes, each owning a slice of the gateway shards.
+
+    python cluster.py --processes 4              # shard count recommended by Discord
+    python cluster.py --processes 4 --shards 16
+
+The supervisor assigns shards round robin (worker i gets shards i, i+N, ...), starts one
+AutoShardedBot per worker and restarts crashed workers with backoff. A guild lives on
+shard (guild_id >> 22) % shard_count, so each worker loads only its own guilds into the
+store. Config changes made by slash commands are sent to the supervisor, which relays
+them to the worker owning the guild.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import urllib.request
+from multiprocessing.connection import Connection, wait
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+# A worker that stays up this long has its restart backoff reset
+_STABLE_AFTER = 60.0
+_MAX_BACKOFF = 60.0
+
+
+def shard_for(guild_id: int, shard_count: int) -> int:
+    """The gateway shard Discord routes a guild's events to."""
+    return (guild_id >> 22) % shard_count
+
+
+def recommended_shards(token: str) -> int:
+    """Shard count Discord recommends for this bot (GET /gateway/bot)."""
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot (cluster, 1.0)"},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return int(json.load(response)["shards"])
+
+
+class ClusterLink:
+    """Worker side of the supervisor pipe: publishes local config changes, applies relayed ones."""
+
+    def __init__(self, conn: Connection, shard_ids: Sequence[int], shard_count: int):
+        self.conn = conn
+        self.shard_ids = set(shard_ids)
+        self.shard_count = shard_count
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.received = 0
+
+    def owns(self, guild_id: int) -> bool:
+        return shard_for(guild_id, self.shard_count) in self.shard_ids
+
+    def publish(self, config, attrs: Tuple[str, ...]) -> None:
+        """ConfigWriter listener: forward a change to the guild's owner if that's another worker."""
+        if self.owns(config.server_id):
+            return
+        self.conn.send({
+            "type": "config",
+            "server_id": config.server_id,
+            "values": {attr: getattr(config, attr) for attr in attrs},
+        })
+        self.sent += 1
+
+    async def on_ready(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._receive())
+
+    async def _receive(self) -> None:
+        from store import apply_values
+
+        while True:
+            try:
+                message = await asyncio.to_thread(self.conn.recv)
+            except (EOFError, OSError):
+                print("Lost connection to cluster supervisor, exiting")
+                os._exit(1)
+            if message.get("type") == "config":
+                apply_values(message["server_id"], message["values"])
+                self.received += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {"shards": len(self.shard_ids), "shard_count": self.shard_count, "sent": self.sent, "received": self.received}
+
+
+def _suffixed(path: str, index: int) -> str:
+    base, ext = os.path.splitext(path)
+    return f"{base}.{index}{ext}"
+
+
+def _worker_main(index: int, shard_ids: List[int], shard_count: int, conn: Connection) -> None:
+    load_dotenv()
+    os.environ["SHARD_IDS"] = ",".join(map(str, shard_ids))
+    os.environ["SHARD_COUNT"] = str(shard_count)
+    # Per-worker journal, snapshot and metrics port
+    os.environ["CONFIG_JOURNAL_PATH"] = _suffixed(os.getenv("CONFIG_JOURNAL_PATH", "config_journal.jsonl"), index)
+    os.environ["SNAPSHOT_PATH"] = _suffixed(os.getenv("SNAPSHOT_PATH", "bot_snapshot.bin"), index)
+    if os.getenv("METRICS_PORT"):
+        os.environ["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+
+    import bot as bot_module
+    from metrics import register_stats
+    from persistence import config_writer
+
+    link = ClusterLink(conn, shard_ids, shard_count)
+    config_writer.listeners.append(link.publish)
+    bot_module.bot.add_listener(link.on_ready, "on_ready")
+    register_stats("cluster", link.stats)
+    print(f"Worker {index} starting shards {shard_ids} of {shard_count}")
+    # Don't inherit the supervisor's SIGTERM handler; once connecting, the bot closes on SIGTERM
+    # (saving the final snapshot, see bot.py)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    bot_module.bot.run(os.environ["DISCORD_BOT_TOKEN"])
+
+
+class _Worker:
+    def __init__(self, index: int, shard_ids: List[int]):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn: Optional[Connection] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        # When a crashed worker may be started again
+        self.restart_at: Optional[float] = None
+
+
+class Supervisor:
+    def __init__(self, processes: int, shard_count: int):
+        self.shard_count = shard_count
+        self.processes = min(processes, shard_count)
+        self._ctx = multiprocessing.get_context("spawn")
+        self.workers = [
+            _Worker(i, [s for s in range(shard_count) if s % self.processes == i])
+            for i in range(self.processes)
+        ]
+        self._stopping = False
+
+    def owner_of(self, guild_id: int) -> _Worker:
+        return self.workers[shard_for(guild_id, self.shard_count) % self.processes]
+
+    def _start(self, worker: _Worker) -> None:
+        parent_conn, child_conn = self._ctx.Pipe()
+        worker.process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker.index, worker.shard_ids, self.shard_count, child_conn),
+            name=f"bot-worker-{worker.index}",
+        )
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.started_at = time.monotonic()
+        worker.restart_at = None
+
+    def _on_exit(self, worker: _Worker) -> None:
+        code = worker.process.exitcode
+        worker.conn.close()
+        worker.process = worker.conn = None
+        if self._stopping:
+            return
+        if time.monotonic() - worker.started_at >= _STABLE_AFTER:
+            worker.restarts = 0
+        delay = min(_MAX_BACKOFF, 2.0 ** worker.restarts)
+        worker.restarts += 1
+        worker.restart_at = time.monotonic() + delay
+        print(f"Worker {worker.index} exited with code {code}, restarting in {delay:.0f}s")
+
+    def _relay(self, sender: _Worker, message: dict) -> None:
+        if message.get("type") != "config":
+            return
+        owner = self.owner_of(message["server_id"])
+        if owner is sender or owner.conn is None:
+            # Owner is restarting and will load the change from Supabase
+            return
+        try:
+            owner.conn.send(message)
+        except (BrokenPipeError, OSError):
+            pass
+
+    def run(self) -> None:
+        for worker in self.workers:
+            self._start(worker)
+        while not self._stopping:
+            now = time.monotonic()
+            for worker in self.workers:
+                if worker.process is None and worker.restart_at is not None and now >= worker.restart_at:
+                    self._start(worker)
+            live = [w for w in self.workers if w.process is not None]
+            ready = wait([w.conn for w in live] + [w.process.sentinel for w in live], timeout=1.0)
+            for worker in live:
+                if worker.conn in ready:
+                    try:
+                        self._relay(worker, worker.conn.recv())
+                    except (EOFError, OSError):
+                        pass
+                if worker.process.sentinel in ready:
+                    worker.process.join()
+                    self._on_exit(worker)
+
+    def stop(self, *_) -> None:
+        self._stopping = True
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join(10)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Run the bot as a sharded multi-process cluster")
+    parser.add_argument("--processes", type=int, default=int(os.getenv("CLUSTER_PROCESSES", os.cpu_count() or 1)))
+    parser.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")), help="total shards (default: Discord's recommendation)")
+    args = parser.parse_args(argv)
+
+    token = os.getenv("DISCORD_BOT_TOKEN")
+    if not token:
+        print("Error: DISCORD_BOT_TOKEN not found!")
+        exit(1)
+    shard_count = args.shards or max(recommended_shards(token), args.processes)
+    supervisor = Supervisor(args.processes, shard_count)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    print(f"Starting {supervisor.processes} worker(s) for {shard_count} shard(s)")
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == "__main__":
+    main()
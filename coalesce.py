@@ -0,0 +1,153 @@
+"""Per-channel debounce of reply triggers, so a burst of messages gets one reply to its latest state."""
+import asyncio
+import os
+import time
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Set, Tuple
+
+# Wait this long after the last message in a burst before generating
+REPLY_QUIET_WINDOW = float(os.getenv("REPLY_QUIET_WINDOW", "1.5"))
+# ...but never delay a triggered reply longer than this
+REPLY_MAX_WAIT = float(os.getenv("REPLY_MAX_WAIT", "4"))
+
+# Trigger reasons
+MENTION = "mention"
+REPLY = "reply"
+CHANCE = "chance"
+
+
+class _Pending:
+    __slots__ = ("message", "triggers", "first_at", "timer", "ready")
+
+    def __init__(self, message, triggers: Set[str], first_at: float):
+        self.message = message
+        self.triggers = triggers
+        self.first_at = first_at
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.ready = False
+
+
+class ReplyCoalescer:
+    """Merges reply triggers per channel and runs at most one generation per channel at a time.
+
+    `handler(message, triggers)` generates and sends the reply for the latest message.
+    It must call `commit(channel_id)` right before it starts sending; until then a
+    newer message makes the generation stale and it is cancelled and rescheduled,
+    keeping its original deadline. Once `max_wait` has passed since the first trigger
+    it is no longer cancelled; newer messages get a follow-up reply after it.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[object, Set[str]], Awaitable[None]],
+        quiet_window: float = REPLY_QUIET_WINDOW,
+        max_wait: float = REPLY_MAX_WAIT,
+    ):
+        self._handler = handler
+        self.quiet_window = quiet_window
+        self.max_wait = max_wait
+        self._pending: Dict[int, _Pending] = {}
+        # channel_id -> (generation task, the pending reply it answers)
+        self._running: Dict[int, Tuple[asyncio.Task, _Pending]] = {}
+        self._committed: Set[int] = set()
+        self.merged = 0
+        self.stale_cancelled = 0
+
+    def trigger(self, channel_id: int, message, triggers: Set[str]) -> None:
+        """Schedule (or extend) a reply for this channel answering `message`."""
+        pending = self._pending.get(channel_id)
+        if pending is not None:
+            pending.message = message
+            pending.triggers |= triggers
+            self.merged += 1
+        else:
+            stale = self._cancel_stale(channel_id)
+            if stale is not None:
+                # The restarted reply keeps the original deadline, so a busy channel can't postpone it forever
+                pending = _Pending(message, set(triggers) | stale.triggers, stale.first_at)
+            else:
+                pending = _Pending(message, set(triggers), time.monotonic())
+            self._pending[channel_id] = pending
+        if not pending.ready:
+            self._arm(channel_id, pending)
+
+    def note_activity(self, channel_id: int, message) -> None:
+        """A message that didn't trigger a reply; it still moves a pending or in-progress reply forward."""
+        if channel_id in self._pending or self._cancellable(channel_id):
+            self.trigger(channel_id, message, set())
+
+    def commit(self, channel_id: int) -> None:
+        """Mark the channel's running generation as sending; it will no longer be cancelled."""
+        self._committed.add(channel_id)
+
+    def _cancellable(self, channel_id: int) -> bool:
+        """Whether the running generation may still be replaced: not sending yet and not past its max wait."""
+        running = self._running.get(channel_id)
+        if running is None or channel_id in self._committed:
+            return False
+        return time.monotonic() - running[1].first_at < self.max_wait
+
+    def _cancel_stale(self, channel_id: int) -> Optional[_Pending]:
+        """Cancel the running generation if it may be replaced; returns what it was answering.
+
+        Past the max wait it is left to finish and newer messages get a follow-up reply.
+        """
+        if not self._cancellable(channel_id):
+            return None
+        task, pending = self._running.pop(channel_id)
+        task.cancel()
+        self.stale_cancelled += 1
+        return pending
+
+    def _arm(self, channel_id: int, pending: _Pending) -> None:
+        if pending.timer is not None:
+            pending.timer.cancel()
+        remaining = pending.first_at + self.max_wait - time.monotonic()
+        delay = max(0.0, min(self.quiet_window, remaining))
+        pending.timer = asyncio.get_running_loop().call_later(delay, self._fire, channel_id)
+
+    def _fire(self, channel_id: int) -> None:
+        pending = self._pending.get(channel_id)
+        if pending is None:
+            return
+        pending.timer = None
+        if channel_id in self._running:
+            # Previous reply is still being sent; start right after it finishes
+            pending.ready = True
+            return
+        del self._pending[channel_id]
+        self._start(channel_id, pending)
+
+    def _start(self, channel_id: int, pending: _Pending) -> None:
+        task = asyncio.ensure_future(self._handler(pending.message, pending.triggers))
+        self._running[channel_id] = (task, pending)
+        task.add_done_callback(lambda t: self._finished(channel_id, t))
+
+    def _finished(self, channel_id: int, task: asyncio.Task) -> None:
+        running = self._running.get(channel_id)
+        if running is not None and running[0] is task:
+            del self._running[channel_id]
+            self._committed.discard(channel_id)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Reply generation failed in channel {channel_id}: {task.exception()}")
+        pending = self._pending.get(channel_id)
+        if pending is not None and pending.ready and channel_id not in self._running:
+            del self._pending[channel_id]
+            self._start(channel_id, pending)
+
+    def unanswered(self) -> Iterator[Tuple[int, object, Set[str]]]:
+        """(channel_id, message, triggers) for every reply not yet being sent: waiting or generating."""
+        for channel_id, (_, running) in self._running.items():
+            if channel_id not in self._committed and channel_id not in self._pending:
+                yield channel_id, running.message, set(running.triggers)
+        for channel_id, pending in self._pending.items():
+            running = self._running.get(channel_id)
+            inherited = running[1].triggers if running is not None and channel_id not in self._committed else set()
+            yield channel_id, pending.message, pending.triggers | inherited
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "running": len(self._running),
+            "merged": self.merged,
+            "stale_cancelled": self.stale_cancelled,
+        }
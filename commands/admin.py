@@ -0,0 +1,48 @@
+"""Admin commands: stats."""
+import discord
+from discord import app_commands
+from discord.ext import commands
+
+from metrics import collect_stats, llm_tokens_total, replies_total, stage_seconds
+
+STAGES = ('trigger', 'reference_fetch', 'history', 'context', 'media', 'llm_queue', 'llm', 'webhook_send')
+
+
+def _ms(seconds) -> str:
+    if seconds is None:
+        return '-'
+    if seconds == float('inf'):
+        return '>60s'
+    return f'{seconds * 1000:.0f}ms'
+
+
+def format_stats() -> str:
+    """Plain-text summary of pipeline latency, reply outcomes, token usage and component stats."""
+    lines = ['Stage latency (p50 / p95, all servers):']
+    for stage in STAGES:
+        p50 = stage_seconds.quantile(0.5, stage=stage)
+        if p50 is not None:
+            lines.append(f'  {stage:<16} {_ms(p50):>7} / {_ms(stage_seconds.quantile(0.95, stage=stage))}')
+    outcomes = ('sent', 'empty', 'cancelled', 'dropped', 'timeout', 'error', 'send_error')
+    lines.append('Replies: ' + ', '.join(f'{o} {replies_total.total(outcome=o):g}' for o in outcomes))
+    lines.append(
+        f'Tokens: input {llm_tokens_total.total(kind="input"):g} (estimated {llm_tokens_total.total(kind="estimated_input"):g}), '
+        f'output {llm_tokens_total.total(kind="output"):g}'
+    )
+    for component, stats in collect_stats().items():
+        values = ', '.join(f'{k} {v:.3g}' if isinstance(v, float) else f'{k} {v}' for k, v in stats.items())
+        lines.append(f'{component}: {values}')
+    return '\n'.join(lines)
+
+
+def setup(bot: commands.Bot) -> None:
+    """Register admin commands with the bot."""
+
+    @bot.tree.command(name='stats', description='Show bot latency and throughput stats')
+    @app_commands.default_permissions(administrator=True)
+    async def stats(interaction: discord.Interaction):
+        # Stats cover every server the bot is in, so only the bot's owner may see them
+        if not await bot.is_owner(interaction.user):
+            await interaction.response.send_message('Only the bot owner can view stats.', ephemeral=True)
+            return
+        await interaction.response.send_message(f'```\n{format_stats()[:1900]}\n```', ephemeral=True)
@@ -1,17 +1,16 @@
-"""Server configuration commands: setchannel, changename, changeavatar."""
+"""Server configuration commands: setchannel, changename, changeavatar, setpersonality, toggle, setmodel.
+
+Changes apply to the in-memory store immediately and are persisted in the background (see persistence.py).
+"""
 import discord
 from discord import app_commands
 from discord.ext import commands
 
-from supabase_client import get_supabase
-from store import (
-    watched_channels,
-    webhook_by_server,
-    webhook_name_by_server,
-    webhook_avatar_by_server,
-    personality_by_server,
-    enabled_by_server,
-)
+from ai.prefix import prompt_prefixes
+from ai.router import TIER_AUTO, TIER_FAST, TIER_FULL
+from delivery import delivery as webhook_delivery
+from persistence import config_writer
+from store import ensure_server, fetch_server, set_channel
 
 
 def setup(bot: commands.Bot) -> None:
@@ -28,46 +27,25 @@ def setup(bot: commands.Bot) -> None:
             )
             return
 
-        server_id = str(interaction.guild_id)
-        channel_id = str(channel.id)
         try:
-            supabase = get_supabase()
-            if server_id in webhook_by_server:
-                old_id, old_token = webhook_by_server[server_id]
+            # The startup load may not have reached this server yet; don't lose its old webhook or `enabled`
+            config = await fetch_server(interaction.guild_id, config_writer.pending)
+            if config is not None and config.webhook_id:
                 try:
-                    old_webhook = discord.Webhook.partial(int(old_id), old_token, client=bot)
-                    await old_webhook.delete()
+                    await webhook_delivery.webhook(config.webhook_id, config.webhook_token).delete()
                 except Exception:
                     pass
-                del webhook_by_server[server_id]
+                webhook_delivery.forget(config.webhook_id)
+                set_channel(interaction.guild_id, config.channel_id, None, None)
 
             webhook = await channel.create_webhook(name='Unnamed')
 
-            payload = {
-                'server_id': server_id,
-                'channel_id': channel_id,
-                'webhook_id': str(webhook.id),
-                'webhook_token': webhook.token,
-            }
-            existing = supabase.table('servers').select('webhook_name, webhook_avatar_url, personality, enabled').eq('server_id', server_id).execute()
-            if existing.data and len(existing.data) > 0:
-                row = existing.data[0]
-                if row.get('webhook_name') is not None:
-                    payload['webhook_name'] = row['webhook_name']
-                if row.get('webhook_avatar_url') is not None:
-                    payload['webhook_avatar_url'] = row['webhook_avatar_url']
-                if row.get('personality') is not None:
-                    payload['personality'] = row['personality']
-                if row.get('enabled') is not None:
-                    payload['enabled'] = row['enabled']
-            else:
-                payload['enabled'] = True
-            supabase.table('servers').upsert(payload, on_conflict='server_id').execute()
-
-            watched_channels[server_id] = channel_id
-            if webhook.token:
-                webhook_by_server[server_id] = (str(webhook.id), webhook.token)
-            print(f'Added to watch list: server {server_id}, channel {channel_id}, webhook {webhook.id}')
+            changed = ['channel_id', 'webhook_id', 'webhook_token']
+            if config is None:
+                changed.append('enabled')
+            config = set_channel(interaction.guild_id, channel.id, webhook.id, webhook.token)
+            config_writer.mark(config, *changed)
+            print(f'Added to watch list: server {config.server_id}, channel {channel.id}, webhook {webhook.id}')
 
             await interaction.response.send_message(
                 f'Channel set to {channel.mention} for this server (webhook created).',
@@ -86,11 +64,11 @@ def setup(bot: commands.Bot) -> None:
             await interaction.response.send_message('Name cannot be empty.', ephemeral=True)
             return
         name = name.strip()[:80]
-        server_id = str(interaction.guild_id)
         try:
-            supabase = get_supabase()
-            supabase.table('servers').update({'webhook_name': name}).eq('server_id', server_id).execute()
-            webhook_name_by_server[server_id] = name
+            config = ensure_server(interaction.guild_id)
+            config.name = name
+            config_writer.mark(config, 'name')
+            prompt_prefixes.invalidate(config.server_id)
             await interaction.response.send_message(f'Bot Name set to **{name}**.')
         except Exception as e:
             await interaction.response.send_message(f'Failed to save: {e}', ephemeral=True)
@@ -106,11 +84,10 @@ def setup(bot: commands.Bot) -> None:
                 ephemeral=True,
             )
             return
-        server_id = str(interaction.guild_id)
         try:
-            supabase = get_supabase()
-            supabase.table('servers').update({'webhook_avatar_url': url}).eq('server_id', server_id).execute()
-            webhook_avatar_by_server[server_id] = url
+            config = ensure_server(interaction.guild_id)
+            config.avatar_url = url
+            config_writer.mark(config, 'avatar_url')
             await interaction.response.send_message('Bot Avatar updated')
         except Exception as e:
             await interaction.response.send_message(f'Failed to save: {e}', ephemeral=True)
@@ -126,16 +103,11 @@ def setup(bot: commands.Bot) -> None:
                 ephemeral=True,
             )
             return
-        server_id = str(interaction.guild_id)
         try:
-            supabase = get_supabase()
-            result = supabase.table('servers').update({'personality': text}).eq('server_id', server_id).execute()
-            if not result.data:
-                supabase.table('servers').upsert(
-                    {'server_id': server_id, 'personality': text},
-                    on_conflict='server_id',
-                ).execute()
-            personality_by_server[server_id] = text
+            config = ensure_server(interaction.guild_id)
+            config.personality = text
+            config_writer.mark(config, 'personality')
+            prompt_prefixes.invalidate(config.server_id)
             await interaction.response.send_message('Personality updated.')
         except Exception as e:
             await interaction.response.send_message(f'Failed to save: {e}', ephemeral=True)
@@ -144,12 +116,11 @@ def setup(bot: commands.Bot) -> None:
     @app_commands.default_permissions(manage_guild=True)
     @app_commands.describe(on='Turn replies on (true) or off (false)')
     async def toggle(interaction: discord.Interaction, on: bool):
-        server_id = str(interaction.guild_id)
         try:
-            supabase = get_supabase()
-            result = supabase.table('servers').update({'enabled': on}).eq('server_id', server_id).execute()
-            if result.data and len(result.data) > 0:
-                enabled_by_server[server_id] = on
+            config = await fetch_server(interaction.guild_id, config_writer.pending)
+            if config is not None and config.watching:
+                config.enabled = on
+                config_writer.mark(config, 'enabled')
                 status = 'on' if on else 'off'
                 await interaction.response.send_message(f'AI replies are now **{status}**.')
             else:
@@ -159,3 +130,20 @@ def setup(bot: commands.Bot) -> None:
                 )
         except Exception as e:
             await interaction.response.send_message(f'Failed to save: {e}', ephemeral=True)
+
+    @bot.tree.command(name='setmodel', description='Choose which model tier answers in this server')
+    @app_commands.default_permissions(manage_guild=True)
+    @app_commands.describe(tier='auto: full model for mentions, replies and images, fast model otherwise')
+    @app_commands.choices(tier=[
+        app_commands.Choice(name='auto', value=TIER_AUTO),
+        app_commands.Choice(name='full', value=TIER_FULL),
+        app_commands.Choice(name='fast', value=TIER_FAST),
+    ])
+    async def setmodel(interaction: discord.Interaction, tier: app_commands.Choice[str]):
+        try:
+            config = ensure_server(interaction.guild_id)
+            config.model_tier = None if tier.value == TIER_AUTO else tier.value
+            config_writer.mark(config, 'model_tier')
+            await interaction.response.send_message(f'Model tier set to **{tier.name}**.')
+        except Exception as e:
+            await interaction.response.send_message(f'Failed to save: {e}', ephemeral=True)
@@ -0,0 +1,147 @@
+"""Per-channel ring buffer of recent messages, so replies don't need a history fetch every time."""
+import asyncio
+from collections import deque
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from ai.gemini import get_media_urls_from_message
+
+# Messages kept per watched channel (must be >= the reply context size)
+BUFFER_SIZE = 25
+
+
+class MessageRecord(NamedTuple):
+    """A message normalized once on arrival: author display name, stripped text, media URLs."""
+    id: int
+    author_id: int
+    author: str
+    content: str
+    media_urls: List[str]
+    # id of the message this one replies to, if any
+    reply_to: Optional[int] = None
+
+
+# channel_id -> recent messages, oldest first
+_buffers: Dict[int, Deque[MessageRecord]] = {}
+# channel ids whose buffer has been backfilled from Discord at least once
+_warm_channels: Set[int] = set()
+# channel_id -> in-flight backfill, so concurrent replies share one REST call
+_backfills: Dict[int, asyncio.Task] = {}
+
+
+def make_record(message) -> MessageRecord:
+    """Normalize a discord.Message into a MessageRecord."""
+    author = message.author.display_name if hasattr(message.author, 'display_name') else str(message.author)
+    return MessageRecord(
+        id=message.id,
+        author_id=message.author.id,
+        author=author,
+        content=(message.content or "").strip(),
+        media_urls=get_media_urls_from_message(message),
+        reply_to=message.reference.message_id if message.reference is not None else None,
+    )
+
+
+def _buffer(channel_id: int) -> Deque[MessageRecord]:
+    buf = _buffers.get(channel_id)
+    if buf is None:
+        buf = _buffers[channel_id] = deque(maxlen=BUFFER_SIZE)
+    return buf
+
+
+def record_message(message) -> MessageRecord:
+    """Append a newly received message to its channel's buffer."""
+    record = make_record(message)
+    buf = _buffer(message.channel.id)
+    if buf and buf[-1].id >= record.id:
+        # Out-of-order delivery (rare): merge instead of appending
+        _merge(message.channel.id, [record])
+    else:
+        buf.append(record)
+    return record
+
+
+def apply_edit(channel_id: int, message_id: int, data: dict) -> None:
+    """Apply a raw MESSAGE_UPDATE payload to a buffered message, if we have it."""
+    buf = _buffers.get(channel_id)
+    if not buf:
+        return
+    for i, record in enumerate(buf):
+        if record.id == message_id:
+            if 'content' in data:
+                buf[i] = record._replace(content=(data.get('content') or "").strip())
+            return
+
+
+def remove_messages(channel_id: int, message_ids) -> None:
+    """Drop deleted messages from a channel's buffer."""
+    buf = _buffers.get(channel_id)
+    if not buf:
+        return
+    ids = set(message_ids)
+    kept = [r for r in buf if r.id not in ids]
+    if len(kept) != len(buf):
+        buf.clear()
+        buf.extend(kept)
+
+
+def forget_channel(channel_id: int) -> None:
+    """Drop a channel's buffer (e.g. when the server's watched channel changes)."""
+    _buffers.pop(channel_id, None)
+    _warm_channels.discard(channel_id)
+
+
+def buffers() -> Iterator[Tuple[int, List[MessageRecord], bool]]:
+    """(channel_id, records oldest first, backfilled?) for every buffered channel."""
+    for channel_id, buf in _buffers.items():
+        yield channel_id, list(buf), channel_id in _warm_channels
+
+
+def restore_buffer(channel_id: int, records: List[MessageRecord], warm: bool) -> None:
+    """Refill a channel's buffer, e.g. from a snapshot; `warm` skips the backfill before the next reply."""
+    _merge(channel_id, records)
+    if warm:
+        _warm_channels.add(channel_id)
+
+
+async def revalidate(channel) -> None:
+    """Replace a (restored) buffer with Discord's history, keeping buffered messages newer than it."""
+    fetched = [make_record(msg) async for msg in channel.history(limit=BUFFER_SIZE)]
+    newest = max((r.id for r in fetched), default=0)
+    buf = _buffer(channel.id)
+    records = sorted(fetched, key=lambda r: r.id) + [r for r in buf if r.id > newest]
+    buf.clear()
+    buf.extend(records[-BUFFER_SIZE:])
+    _warm_channels.add(channel.id)
+
+
+def _merge(channel_id: int, records: List[MessageRecord]) -> None:
+    buf = _buffer(channel_id)
+    by_id = {r.id: r for r in records}
+    # Records already in the buffer came from the gateway and are at least as fresh
+    by_id.update((r.id, r) for r in buf)
+    merged = sorted(by_id.values(), key=lambda r: r.id)
+    buf.clear()
+    buf.extend(merged[-BUFFER_SIZE:])
+
+
+async def _backfill(channel) -> None:
+    records = [make_record(msg) async for msg in channel.history(limit=BUFFER_SIZE)]
+    _merge(channel.id, records)
+    _warm_channels.add(channel.id)
+
+
+async def get_recent_messages(channel, limit: int, before_id: Optional[int] = None) -> List[MessageRecord]:
+    """Return up to `limit` buffered messages older than `before_id`, backfilling a cold buffer via REST once."""
+    if channel.id not in _warm_channels:
+        task = _backfills.get(channel.id)
+        if task is None:
+            task = _backfills[channel.id] = asyncio.ensure_future(_backfill(channel))
+            task.add_done_callback(lambda _t, cid=channel.id: _backfills.pop(cid, None))
+        try:
+            await asyncio.shield(task)
+        except Exception as e:
+            print(f"History backfill failed for channel {channel.id}: {e}")
+    records = list(_buffers.get(channel.id, ()))
+    if before_id is not None:
+        records = [r for r in records if r.id < before_id]
+    return records[-limit:] if limit > 0 else []
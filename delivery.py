@@ -0,0 +1,158 @@
+"""Webhook delivery: one cached webhook per server, an ordered send queue per webhook, rate-limit pacing and retries.
+
+Webhook objects are created with the bot as client, so every send reuses the bot's
+HTTP session. discord.py consumes the rate-limit headers of successful responses
+internally, so sends are paced ahead of time with a local window matching Discord's
+per-webhook limit, and the headers of 429 responses are used to back off.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import discord
+
+# Discord allows roughly this many executions per webhook per period
+WEBHOOK_RATE_COUNT = int(os.getenv("WEBHOOK_RATE_COUNT", "5"))
+WEBHOOK_RATE_PERIOD = float(os.getenv("WEBHOOK_RATE_PERIOD", "2"))
+WEBHOOK_MAX_RETRIES = int(os.getenv("WEBHOOK_MAX_RETRIES", "3"))
+# Per-webhook sender tasks exit after this long without work
+_IDLE_SECONDS = 60.0
+
+
+def _retry_after(exc: discord.HTTPException, attempt: int) -> float:
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    for header in ("Retry-After", "X-RateLimit-Reset-After"):
+        try:
+            return float(headers[header])
+        except (KeyError, TypeError, ValueError):
+            pass
+    return min(2.0 ** attempt, 30.0)
+
+
+class _Lane:
+    """Send queue and pacing state for one webhook."""
+    __slots__ = ("queue", "worker", "sent_at", "blocked_until")
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.worker: Optional[asyncio.Task] = None
+        self.sent_at: Deque[float] = deque(maxlen=WEBHOOK_RATE_COUNT)
+        self.blocked_until = 0.0
+
+    def delay(self) -> float:
+        now = time.monotonic()
+        wait = self.blocked_until - now
+        if len(self.sent_at) == self.sent_at.maxlen:
+            wait = max(wait, self.sent_at[0] + WEBHOOK_RATE_PERIOD - now)
+        return max(0.0, wait)
+
+
+class WebhookDelivery:
+    """Delivers webhook messages in order per webhook, pacing sends and retrying on 429."""
+
+    def __init__(self):
+        self._client = None
+        # (webhook_id, token) -> webhook-like object with async send(); defaults to discord.Webhook.partial
+        self.webhook_factory = None
+        # webhook_id -> (token, webhook)
+        self._webhooks: Dict[int, Tuple[str, discord.Webhook]] = {}
+        self._lanes: Dict[int, _Lane] = {}
+        self._latencies: Deque[float] = deque(maxlen=1000)
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def bind(self, client) -> None:
+        """Use `client`'s HTTP session for all webhook requests."""
+        self._client = client
+
+    def webhook(self, webhook_id: int, token: str) -> discord.Webhook:
+        """Return the cached webhook object for this id, creating it once."""
+        cached = self._webhooks.get(webhook_id)
+        if cached is None or cached[0] != token:
+            if self.webhook_factory is not None:
+                webhook = self.webhook_factory(webhook_id, token)
+            else:
+                webhook = discord.Webhook.partial(webhook_id, token, client=self._client)
+            cached = self._webhooks[webhook_id] = (token, webhook)
+        return cached[1]
+
+    def forget(self, webhook_id: int) -> None:
+        """Drop a webhook that was deleted or replaced."""
+        self._webhooks.pop(webhook_id, None)
+
+    async def send(self, webhook_id: int, token: str, **kwargs) -> Optional[discord.WebhookMessage]:
+        """Queue a webhook message behind earlier sends on the same webhook and wait until it is delivered."""
+        lane = self._lanes.get(webhook_id)
+        if lane is None:
+            lane = self._lanes[webhook_id] = _Lane()
+        future = asyncio.get_running_loop().create_future()
+        lane.queue.put_nowait((token, kwargs, future, time.monotonic()))
+        if lane.worker is None or lane.worker.done():
+            lane.worker = asyncio.ensure_future(self._run_lane(webhook_id, lane))
+        return await future
+
+    async def _run_lane(self, webhook_id: int, lane: _Lane) -> None:
+        while True:
+            try:
+                token, kwargs, future, queued_at = await asyncio.wait_for(lane.queue.get(), _IDLE_SECONDS)
+            except asyncio.TimeoutError:
+                if lane.queue.empty():
+                    self._lanes.pop(webhook_id, None)
+                    return
+                continue
+            if future.cancelled():
+                continue
+            try:
+                message = await self._deliver(webhook_id, token, lane, kwargs)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            self.sent += 1
+            self._latencies.append(time.monotonic() - queued_at)
+            if not future.done():
+                future.set_result(message)
+
+    async def _deliver(self, webhook_id: int, token: str, lane: _Lane, kwargs: dict):
+        attempt = 0
+        while True:
+            delay = lane.delay()
+            if delay:
+                await asyncio.sleep(delay)
+            lane.sent_at.append(time.monotonic())
+            try:
+                return await self.webhook(webhook_id, token).send(wait=True, **kwargs)
+            except discord.NotFound:
+                self.forget(webhook_id)
+                raise
+            except discord.HTTPException as e:
+                if attempt >= WEBHOOK_MAX_RETRIES or not (e.status == 429 or e.status >= 500):
+                    raise
+                backoff = _retry_after(e, attempt)
+                lane.blocked_until = time.monotonic() + backoff
+                attempt += 1
+                self.retried += 1
+                print(f"Webhook {webhook_id} send failed ({e.status}), retrying in {backoff:.1f}s")
+
+    def stats(self) -> Dict[str, float]:
+        """Delivery counters and queue-to-delivery latency percentiles (seconds)."""
+        latencies = sorted(self._latencies)
+
+        def pct(p: float) -> float:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "queued": sum(lane.queue.qsize() for lane in self._lanes.values()),
+            "sent": self.sent,
+            "retried": self.retried,
+            "failed": self.failed,
+            "latency_p50": pct(0.50),
+            "latency_p95": pct(0.95),
+        }
+
+
+delivery = WebhookDelivery()
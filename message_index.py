@@ -0,0 +1,87 @@
+"""Recently seen message ids per channel, split into ours (webhook/bot) and everyone else's.
+
+Lets reply detection answer "is this a reply to the bot?" without fetch_message.
+Both sides are bounded per channel and expire; the non-bot side is a short negative cache.
+"""
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+BOT_MESSAGE_TTL = float(os.getenv("BOT_MESSAGE_TTL", str(24 * 3600)))
+BOT_MESSAGE_INDEX_SIZE = int(os.getenv("BOT_MESSAGE_INDEX_SIZE", "500"))
+NON_BOT_MESSAGE_TTL = float(os.getenv("NON_BOT_MESSAGE_TTL", "600"))
+NON_BOT_MESSAGE_INDEX_SIZE = int(os.getenv("NON_BOT_MESSAGE_INDEX_SIZE", "200"))
+
+
+class _ExpiringIds:
+    """Per-channel message id -> expiry, oldest first, bounded per channel."""
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self._channels: Dict[int, "OrderedDict[int, float]"] = {}
+
+    def add(self, channel_id: int, message_id: int, ttl: Optional[float] = None) -> None:
+        ids = self._channels.get(channel_id)
+        if ids is None:
+            ids = self._channels[channel_id] = OrderedDict()
+        ids[message_id] = time.monotonic() + (self.ttl if ttl is None else ttl)
+        ids.move_to_end(message_id)
+        while len(ids) > self.size:
+            ids.popitem(last=False)
+
+    def __contains__(self, key) -> bool:
+        channel_id, message_id = key
+        ids = self._channels.get(channel_id)
+        if not ids:
+            return False
+        expires = ids.get(message_id)
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            del ids[message_id]
+            return False
+        return True
+
+    def items(self):
+        """(channel_id, message_id, seconds left) for every live entry."""
+        now = time.monotonic()
+        for channel_id, ids in self._channels.items():
+            for message_id, expires in ids.items():
+                if expires > now:
+                    yield channel_id, message_id, expires - now
+
+    def __len__(self) -> int:
+        return sum(len(ids) for ids in self._channels.values())
+
+
+class MessageIndex:
+    def __init__(self):
+        self.bot = _ExpiringIds(BOT_MESSAGE_TTL, BOT_MESSAGE_INDEX_SIZE)
+        self.non_bot = _ExpiringIds(NON_BOT_MESSAGE_TTL, NON_BOT_MESSAGE_INDEX_SIZE)
+        self.hits = 0
+        self.misses = 0
+
+    def add_bot(self, channel_id: int, message_id: int) -> None:
+        self.bot.add(channel_id, message_id)
+
+    def add_non_bot(self, channel_id: int, message_id: int) -> None:
+        self.non_bot.add(channel_id, message_id)
+
+    def lookup(self, channel_id: int, message_id: int) -> Optional[bool]:
+        """True if we sent it, False if someone else did, None if unknown."""
+        if (channel_id, message_id) in self.bot:
+            self.hits += 1
+            return True
+        if (channel_id, message_id) in self.non_bot:
+            self.hits += 1
+            return False
+        self.misses += 1
+        return None
+
+    def stats(self) -> Dict[str, int]:
+        return {"bot": len(self.bot), "non_bot": len(self.non_bot), "hits": self.hits, "misses": self.misses}
+
+
+message_index = MessageIndex()
@@ -0,0 +1,223 @@
+"""In-process metrics: counters and latency histograms, Prometheus text export, optional local scrape endpoint.
+
+Components with their own counters (LLM engine, delivery, ...) register a stats
+callback with `register_stats`; their values are exported as gauges and shown by /stats.
+"""
+import asyncio
+import bisect
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Set to serve /metrics on 127.0.0.1:<port>
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_metrics: List["_Metric"] = []
+_stats_providers: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _metrics.append(self)
+
+    def _key(self, labels: Dict[str, object]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def total(self, **match) -> float:
+        return sum(v for k, v in self._values.items() if self._matches(k, match))
+
+    def _matches(self, key: Tuple[str, ...], match: Dict[str, object]) -> bool:
+        return all(key[self.labelnames.index(n)] == str(v) for n, v in match.items())
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {value:g}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the block; set labels['outcome'] inside it to label the result."""
+        start = time.perf_counter()
+        try:
+            yield labels
+        except asyncio.CancelledError:
+            labels.setdefault("outcome", "cancelled")
+            raise
+        except asyncio.TimeoutError:
+            labels.setdefault("outcome", "timeout")
+            raise
+        except BaseException:
+            labels.setdefault("outcome", "error")
+            raise
+        finally:
+            labels.setdefault("outcome", "ok")
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **match) -> Optional[float]:
+        """Approximate quantile (bucket upper bound) over all series matching `match`."""
+        counts = [0] * (len(self.buckets) + 1)
+        for key, series in self._series.items():
+            if all(key[self.labelnames.index(n)] == str(v) for n, v in match.items()):
+                counts = [a + b for a, b in zip(counts, series[0])]
+        total = sum(counts)
+        if not total:
+            return None
+        seen = 0
+        for i, count in enumerate(counts):
+            seen += count
+            if seen >= q * total:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        for key, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                labels = _format_labels(self.labelnames, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {total:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+def register_stats(component: str, provider: Callable[[], Dict[str, float]]) -> None:
+    """Export a component's stats() dict as gauges named bot_<component>_<key>."""
+    _stats_providers[component] = provider
+
+
+def collect_stats() -> Dict[str, Dict[str, float]]:
+    stats = {}
+    for component, provider in _stats_providers.items():
+        try:
+            stats[component] = provider()
+        except Exception as e:
+            stats[component] = {"error": str(e)}
+    return stats
+
+
+def render() -> str:
+    """All metrics in Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for component, stats in collect_stats().items():
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                name = f"bot_{component}_{key}"
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        # Drain headers
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b"\r\n", b"\n", b""):
+            pass
+        path = request_line.split(b" ")[1] if request_line.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] == b"/metrics":
+            body, status = render().encode(), "200 OK"
+        else:
+            body, status = b"not found\n", "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port: int, host: str = METRICS_HOST) -> asyncio.AbstractServer:
+    """Serve GET /metrics (Prometheus text format) on host:port."""
+    server = await asyncio.start_server(_handle_scrape, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# Pipeline metrics
+stage_seconds = Histogram(
+    "bot_stage_seconds",
+    "Latency of each reply pipeline stage",
+    ("stage", "guild", "outcome"),
+)
+messages_total = Counter("bot_messages_total", "Messages seen in watched channels", ("guild", "outcome"))
+replies_total = Counter("bot_replies_total", "Reply generations by outcome", ("guild", "outcome"))
+llm_tokens_total = Counter("bot_llm_tokens_total", "LLM tokens used", ("guild", "kind"))
+prompt_estimate_ratio = Histogram(
+    "bot_prompt_estimate_ratio",
+    "Actual / locally estimated prompt tokens per LLM call",
+    buckets=(0.5, 0.75, 0.9, 1.0, 1.1, 1.25, 1.5, 2.0, 3.0),
+)
+
+
+def record_usage(guild, usage: Optional[dict]) -> None:
+    """Count tokens from a LangChain usage_metadata dict (plus our prompt estimate, if included)."""
+    if not usage:
+        return
+    for kind in ("input_tokens", "output_tokens", "estimated_input_tokens"):
+        if usage.get(kind):
+            llm_tokens_total.inc(usage[kind], guild=guild, kind=kind.rsplit("_", 1)[0])
+    if usage.get("input_tokens") and usage.get("estimated_input_tokens"):
+        prompt_estimate_ratio.observe(usage["input_tokens"] / usage["estimated_input_tokens"])
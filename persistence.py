@@ -0,0 +1,176 @@
+"""Write-behind persistence of server config.
+
+Slash commands update the in-memory store and call `config_writer.mark(...)`; a
+background task batches the changed columns into upserts to Supabase. Every change
+is appended to a local journal first, so nothing is lost while Supabase is down or
+if the process dies before a flush; the journal is replayed on startup.
+"""
+import asyncio
+import json
+import os
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from store import ServerConfig, apply_values, ensure_server
+from supabase_client import get_supabase
+
+CONFIG_FLUSH_INTERVAL = float(os.getenv("CONFIG_FLUSH_INTERVAL", "2"))
+CONFIG_JOURNAL_PATH = os.getenv("CONFIG_JOURNAL_PATH", "config_journal.jsonl")
+_MAX_BACKOFF = 60.0
+
+# ServerConfig attribute -> `servers` column
+COLUMNS = {
+    'channel_id': 'channel_id',
+    'webhook_id': 'webhook_id',
+    'webhook_token': 'webhook_token',
+    'name': 'webhook_name',
+    'avatar_url': 'webhook_avatar_url',
+    'personality': 'personality',
+    'enabled': 'enabled',
+    'model_tier': 'model_tier',
+}
+_ID_ATTRS = ('channel_id', 'webhook_id')
+
+
+def _column_value(config: ServerConfig, attr: str):
+    value = getattr(config, attr)
+    # Ids are stored as text
+    if attr in _ID_ATTRS and value is not None:
+        return str(value)
+    return value
+
+
+class ConfigWriter:
+    """Coalesces config changes per server and flushes them to Supabase in the background."""
+
+    def __init__(self, journal_path: str = CONFIG_JOURNAL_PATH, interval: float = CONFIG_FLUSH_INTERVAL):
+        self.journal_path = journal_path
+        self.interval = interval
+        # server_id -> ServerConfig attributes changed since the last successful flush
+        self._dirty: Dict[int, Set[str]] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Called with (config, attrs) on every change, e.g. to tell other cluster processes
+        self.listeners: List[Callable[[ServerConfig, Tuple[str, ...]], None]] = []
+        self.flushed = 0
+        self.failures = 0
+
+    def pending(self, server_id: int) -> Set[str]:
+        """Attributes of this server that have local changes not yet written to Supabase."""
+        return self._dirty.get(server_id, set())
+
+    def mark(self, config: ServerConfig, *attrs: str) -> None:
+        """Record that `attrs` of `config` changed; journal them and schedule a flush."""
+        self._journal({'server_id': config.server_id, **{a: getattr(config, a) for a in attrs}})
+        self._dirty.setdefault(config.server_id, set()).update(attrs)
+        self._schedule()
+        for listener in self.listeners:
+            try:
+                listener(config, attrs)
+            except Exception as e:
+                print(f'Config change listener failed: {e}')
+
+    def _journal(self, entry: dict) -> None:
+        # Entries can hold webhook tokens: owner-only permissions
+        fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        with open(fd, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def restore(self) -> int:
+        """Replay journaled changes that may not have reached Supabase into the store; returns how many."""
+        try:
+            with open(self.journal_path, encoding='utf-8') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return 0
+        count = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Torn last line from a crash mid-write
+                continue
+            config = apply_values(int(entry.pop('server_id')), {a: v for a, v in entry.items() if a in COLUMNS})
+            self._dirty.setdefault(config.server_id, set()).update(a for a in entry if a in COLUMNS)
+            count += 1
+        if self._dirty:
+            self._schedule()
+        return count
+
+    def _schedule(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run())
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        backoff = self.interval
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            # Let changes made in quick succession coalesce into one write
+            await asyncio.sleep(self.interval)
+            if await self.flush():
+                backoff = self.interval
+            else:
+                backoff = min(backoff * 2, _MAX_BACKOFF)
+                print(f'Config flush failed, retrying in {backoff:.0f}s')
+                await asyncio.sleep(backoff)
+                self._wakeup.set()
+
+    def _batches(self, dirty: Dict[int, Set[str]]) -> List[Tuple[Dict[int, Set[str]], List[dict]]]:
+        # Bulk upserts need the same columns in every row, so group servers by changed columns
+        groups: Dict[frozenset, Dict[int, Set[str]]] = {}
+        for server_id, attrs in dirty.items():
+            groups.setdefault(frozenset(attrs), {})[server_id] = attrs
+        batches = []
+        for attrs, members in groups.items():
+            rows = []
+            for server_id in members:
+                config = ensure_server(server_id)
+                row = {'server_id': str(server_id)}
+                for attr in attrs:
+                    row[COLUMNS[attr]] = _column_value(config, attr)
+                rows.append(row)
+            batches.append((members, rows))
+        return batches
+
+    def _requeue(self, dirty: Dict[int, Set[str]]) -> None:
+        for server_id, attrs in dirty.items():
+            self._dirty.setdefault(server_id, set()).update(attrs)
+
+    async def flush(self) -> bool:
+        """Write all pending changes now; returns False if any batch failed (it stays pending)."""
+        if not self._dirty:
+            return True
+        dirty, self._dirty = self._dirty, {}
+        try:
+            batches = self._batches(dirty)
+        except Exception as e:
+            self.failures += 1
+            print(f'Failed to prepare config changes for {len(dirty)} server(s): {e}')
+            self._requeue(dirty)
+            return False
+        ok = True
+        for members, rows in batches:
+            try:
+                await asyncio.to_thread(
+                    lambda rows=rows: get_supabase().table('servers').upsert(rows, on_conflict='server_id').execute()
+                )
+                self.flushed += len(rows)
+            except Exception as e:
+                ok = False
+                self.failures += 1
+                print(f'Failed to save config for {len(rows)} server(s): {e}')
+                self._requeue(members)
+        if ok and not self._dirty:
+            # Everything journaled so far is in Supabase
+            open(self.journal_path, 'w').close()
+        return ok
+
+    def stats(self) -> Dict[str, int]:
+        return {'pending': len(self._dirty), 'flushed': self.flushed, 'failures': self.failures}
+
+
+config_writer = ConfigWriter()
@@ -0,0 +1,62 @@
+"""Report the import-time cost of starting the bot, per module and per top-level package.
+
+Usage: python profile_imports.py [module] [--top N]
+
+Runs `python -X importtime -c "import <module>"` (default: bot) in a fresh interpreter
+and summarizes its output, so slow imports on the startup path are easy to spot.
+"""
+import argparse
+import subprocess
+import sys
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+
+def profile(module: str) -> List[Tuple[str, int, int]]:
+    """Import `module` in a subprocess; return (module, self_us, cumulative_us) for every import."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+            entries.append((name.strip(), int(self_us), int(cumulative_us)))
+        except ValueError:
+            continue
+    if proc.returncode != 0:
+        print(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"import {module} failed", file=sys.stderr)
+    return entries
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("module", nargs="?", default="bot")
+    parser.add_argument("--top", type=int, default=15, help="rows per table")
+    args = parser.parse_args()
+
+    entries = profile(args.module)
+    if not entries:
+        sys.exit(1)
+
+    by_package: Dict[str, int] = defaultdict(int)
+    for name, self_us, _ in entries:
+        by_package[name.split(".")[0]] += self_us
+    total_us = sum(by_package.values())
+
+    print(f"Importing {args.module}: {total_us / 1000:.1f} ms across {len(entries)} modules\n")
+    print(f"{'package':<40} {'self ms':>9} {'share':>7}")
+    for package, self_us in sorted(by_package.items(), key=lambda kv: -kv[1])[:args.top]:
+        print(f"{package:<40} {self_us / 1000:>9.1f} {self_us / total_us:>7.1%}")
+
+    print(f"\n{'module':<40} {'self ms':>9} {'cumul ms':>9}")
+    for name, self_us, cumulative_us in sorted(entries, key=lambda e: -e[2])[:args.top]:
+        print(f"{name:<40} {self_us / 1000:>9.1f} {cumulative_us / 1000:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,421 @@
+"""Warm restart: periodic snapshot of in-memory state, restored on boot.
+
+The snapshot holds server configs, per-channel message buffers, channel summaries,
+the bot-message id index, the config sync watermark and replies that were triggered
+but not sent yet. It is a compact binary file written crash-safely (temp file, fsync,
+rename) and read back through mmap, so a restarted bot can answer with full context
+before it has talked to Supabase or Discord. Everything restored is then checked
+against the source of truth in the background: the store is reloaded (or synced from
+the restored watermark), restored channels are refetched, and restored triggers are
+answered only if their message still exists and is recent.
+
+Layout: MAGIC, u32 version, f64 saved-at (unix time), u32 CRC-32 of the body, u64 body
+length, then the body: sections in a fixed order, each a u32 count followed by
+fixed-order fields. Integers are little-endian, strings are u32 length + UTF-8 with
+0xFFFFFFFF for None.
+"""
+import asyncio
+import contextlib
+import mmap
+import os
+import struct
+import time
+import zlib
+from typing import List, NamedTuple, Optional, Set, Tuple
+
+import store
+from conversation import MessageRecord, buffers, restore_buffer, revalidate
+from message_index import message_index
+
+# Seconds between snapshots; 0 disables snapshots and warm restarts
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "bot_snapshot.bin")
+# Restored triggers older than this (seconds since the message was sent) are not answered
+SNAPSHOT_TRIGGER_MAX_AGE = float(os.getenv("SNAPSHOT_TRIGGER_MAX_AGE", "120"))
+# Concurrent history refetches while revalidating restored channels
+_REVALIDATE_CONCURRENCY = 4
+
+MAGIC = b"YKSNAP\r\n"
+VERSION = 1
+_HEADER = struct.Struct("<8sIdIQ")
+_NONE = 0xFFFFFFFF
+_DISCORD_EPOCH_MS = 1420070400000
+
+# ServerConfig attribute -> field kind, in file order
+_SERVER_FIELDS = (
+    ('channel_id', 'id'),
+    ('webhook_id', 'id'),
+    ('webhook_token', 'str'),
+    ('name', 'str'),
+    ('avatar_url', 'str'),
+    ('personality', 'str'),
+    ('enabled', 'bool'),
+    ('model_tier', 'str'),
+)
+_TRIGGER_BITS = ("mention", "reply", "chance")
+
+
+class Snapshot(NamedTuple):
+    saved_at: float
+    servers: List[Tuple[int, dict]]
+    # (channel_id, backfilled?, records)
+    buffers: List[Tuple[int, bool, List[MessageRecord]]]
+    # (channel_id, message_id, seconds left) of our own messages
+    bot_messages: List[Tuple[int, int, float]]
+    summaries: List[Tuple[int, str]]
+    # (channel_id, message_id, triggers)
+    triggers: List[Tuple[int, int, set]]
+    sync_watermark: Optional[Tuple[str, str]]
+
+
+class _Writer:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def u8(self, value: int) -> None:
+        self.buf += struct.pack("<B", value)
+
+    def u32(self, value: int) -> None:
+        self.buf += struct.pack("<I", value)
+
+    def i64(self, value: int) -> None:
+        self.buf += struct.pack("<q", value)
+
+    def f64(self, value: float) -> None:
+        self.buf += struct.pack("<d", value)
+
+    def opt_i64(self, value: Optional[int]) -> None:
+        if value is None:
+            self.u8(0)
+        else:
+            self.u8(1)
+            self.i64(value)
+
+    def str(self, value: Optional[str]) -> None:
+        if value is None:
+            self.u32(_NONE)
+            return
+        data = value.encode("utf-8")
+        self.u32(len(data))
+        self.buf += data
+
+
+class _Reader:
+    """Reads fields straight out of the mapped file."""
+
+    def __init__(self, data, offset: int):
+        self.data = data
+        self.pos = offset
+
+    def _unpack(self, fmt: str):
+        value = struct.unpack_from(fmt, self.data, self.pos)[0]
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def u8(self) -> int:
+        return self._unpack("<B")
+
+    def u32(self) -> int:
+        return self._unpack("<I")
+
+    def i64(self) -> int:
+        return self._unpack("<q")
+
+    def f64(self) -> float:
+        return self._unpack("<d")
+
+    def opt_i64(self) -> Optional[int]:
+        return self.i64() if self.u8() else None
+
+    def str(self) -> Optional[str]:
+        length = self.u32()
+        if length == _NONE:
+            return None
+        value = str(self.data[self.pos:self.pos + length], "utf-8")
+        self.pos += length
+        return value
+
+
+def encode(snapshot: Snapshot) -> bytes:
+    w = _Writer()
+    w.u32(len(snapshot.servers))
+    for server_id, values in snapshot.servers:
+        w.i64(server_id)
+        for attr, kind in _SERVER_FIELDS:
+            value = values.get(attr)
+            if kind == 'id':
+                w.opt_i64(value)
+            elif kind == 'bool':
+                w.u8(1 if value else 0)
+            else:
+                w.str(value)
+    w.u32(len(snapshot.buffers))
+    for channel_id, warm, records in snapshot.buffers:
+        w.i64(channel_id)
+        w.u8(1 if warm else 0)
+        w.u32(len(records))
+        for r in records:
+            w.i64(r.id)
+            w.i64(r.author_id)
+            w.str(r.author)
+            w.str(r.content)
+            w.u32(len(r.media_urls))
+            for url in r.media_urls:
+                w.str(url)
+            w.opt_i64(r.reply_to)
+    w.u32(len(snapshot.bot_messages))
+    for channel_id, message_id, seconds_left in snapshot.bot_messages:
+        w.i64(channel_id)
+        w.i64(message_id)
+        w.f64(seconds_left)
+    w.u32(len(snapshot.summaries))
+    for channel_id, summary in snapshot.summaries:
+        w.i64(channel_id)
+        w.str(summary)
+    w.u32(len(snapshot.triggers))
+    for channel_id, message_id, triggers in snapshot.triggers:
+        w.i64(channel_id)
+        w.i64(message_id)
+        w.u8(sum(1 << i for i, name in enumerate(_TRIGGER_BITS) if name in triggers))
+    w.u8(1 if snapshot.sync_watermark else 0)
+    if snapshot.sync_watermark:
+        w.str(snapshot.sync_watermark[0])
+        w.str(snapshot.sync_watermark[1])
+    body = bytes(w.buf)
+    return _HEADER.pack(MAGIC, VERSION, snapshot.saved_at, zlib.crc32(body), len(body)) + body
+
+
+def decode(data) -> Snapshot:
+    """Parse a snapshot from bytes or a mmap; raises ValueError if it is foreign, truncated or corrupt."""
+    if len(data) < _HEADER.size:
+        raise ValueError("snapshot too short")
+    magic, version, saved_at, crc, length = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a snapshot of this version")
+    if len(data) < _HEADER.size + length or zlib.crc32(memoryview(data)[_HEADER.size:_HEADER.size + length]) != crc:
+        raise ValueError("snapshot body is truncated or corrupt")
+    r = _Reader(data, _HEADER.size)
+    servers = []
+    for _ in range(r.u32()):
+        server_id = r.i64()
+        values = {}
+        for attr, kind in _SERVER_FIELDS:
+            if kind == 'id':
+                values[attr] = r.opt_i64()
+            elif kind == 'bool':
+                values[attr] = bool(r.u8())
+            else:
+                values[attr] = r.str()
+        servers.append((server_id, values))
+    channel_buffers = []
+    for _ in range(r.u32()):
+        channel_id = r.i64()
+        warm = bool(r.u8())
+        records = []
+        for _ in range(r.u32()):
+            message_id, author_id, author, content = r.i64(), r.i64(), r.str(), r.str()
+            media_urls = [r.str() for _ in range(r.u32())]
+            records.append(MessageRecord(message_id, author_id, author, content, media_urls, r.opt_i64()))
+        channel_buffers.append((channel_id, warm, records))
+    bot_messages = [(r.i64(), r.i64(), r.f64()) for _ in range(r.u32())]
+    summaries = [(r.i64(), r.str()) for _ in range(r.u32())]
+    triggers = []
+    for _ in range(r.u32()):
+        channel_id, message_id, bits = r.i64(), r.i64(), r.u8()
+        triggers.append((channel_id, message_id, {name for i, name in enumerate(_TRIGGER_BITS) if bits & (1 << i)}))
+    watermark = (r.str(), r.str()) if r.u8() else None
+    return Snapshot(saved_at, servers, channel_buffers, bot_messages, summaries, triggers, watermark)
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    """Replace `path` with `data` so a crash leaves either the old file or the new one, never a mix.
+
+    The file holds webhook tokens, so it is readable by the owner only.
+    """
+    tmp = f"{path}.tmp"
+    # A leftover temp file would keep its old permissions; start from a fresh one
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp)
+    with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    try:
+        dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(dir_fd)
+    except OSError:
+        pass
+    finally:
+        os.close(dir_fd)
+
+
+def read(path: str) -> Optional[Snapshot]:
+    """Load a snapshot through mmap; None if there is none."""
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return decode(mm)
+
+
+def _message_age(message_id: int) -> float:
+    """Seconds since a Discord message was sent, from its snowflake id."""
+    return time.time() - ((message_id >> 22) + _DISCORD_EPOCH_MS) / 1000
+
+
+class Snapshotter:
+    """Takes periodic snapshots and restores the last one on boot."""
+
+    def __init__(self, coalescer, memory, config_sync=None, path: str = SNAPSHOT_PATH, interval: float = SNAPSHOT_INTERVAL):
+        self.coalescer = coalescer
+        self.memory = memory
+        self.config_sync = config_sync
+        self.path = path
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+        # Triggers restored from the snapshot, answered once the bot is connected
+        self._restored_triggers: List[Tuple[int, int, set]] = []
+        self._restored_channels: List[int] = []
+        # Servers restored from the snapshot; the ones the next full load doesn't return are dropped
+        self.restored_server_ids: Set[int] = set()
+        self.saves = 0
+        self.failures = 0
+        self.last_bytes = 0
+        self.last_save_ms = 0.0
+        self.restored_servers = 0
+        self.restored_messages = 0
+        self.revalidated_channels = 0
+        self.resumed_triggers = 0
+
+    def capture(self) -> Snapshot:
+        """Current state as a Snapshot (runs on the event loop, so it sees a consistent view)."""
+        servers = [
+            (server_id, {attr: getattr(config, attr) for attr, _ in _SERVER_FIELDS})
+            for server_id, config in store.servers.items()
+        ]
+        channel_buffers = [(channel_id, warm, records) for channel_id, records, warm in buffers()]
+        triggers = [
+            (channel_id, message.id, triggers)
+            for channel_id, message, triggers in self.coalescer.unanswered()
+        ]
+        watermark = self.config_sync.watermark if self.config_sync is not None else None
+        return Snapshot(
+            saved_at=time.time(),
+            servers=servers,
+            buffers=channel_buffers,
+            bot_messages=list(message_index.bot.items()),
+            summaries=list(self.memory.summaries()),
+            triggers=triggers,
+            sync_watermark=watermark,
+        )
+
+    def save(self) -> int:
+        """Snapshot synchronously (e.g. at shutdown); returns bytes written."""
+        data = encode(self.capture())
+        write_atomic(self.path, data)
+        return len(data)
+
+    async def save_async(self) -> None:
+        started = time.perf_counter()
+        try:
+            data = encode(self.capture())
+            await asyncio.to_thread(write_atomic, self.path, data)
+        except Exception as e:
+            self.failures += 1
+            print(f"Snapshot failed: {e}")
+            return
+        self.saves += 1
+        self.last_bytes = len(data)
+        self.last_save_ms = (time.perf_counter() - started) * 1000
+
+    def restore(self) -> bool:
+        """Load the last snapshot into memory; True if there was one. Call before connecting."""
+        try:
+            snapshot = read(self.path)
+        except Exception as e:
+            print(f"Ignoring unreadable snapshot {self.path}: {e}")
+            return False
+        if snapshot is None:
+            return False
+        downtime = max(0.0, time.time() - snapshot.saved_at)
+        for server_id, values in snapshot.servers:
+            store.apply_values(server_id, values)
+        for channel_id, warm, records in snapshot.buffers:
+            restore_buffer(channel_id, records, warm)
+            self.restored_messages += len(records)
+        for channel_id, message_id, seconds_left in snapshot.bot_messages:
+            if seconds_left > downtime:
+                message_index.bot.add(channel_id, message_id, seconds_left - downtime)
+        for channel_id, summary in snapshot.summaries:
+            self.memory.restore_summary(channel_id, summary)
+        if self.config_sync is not None and snapshot.sync_watermark is not None:
+            self.config_sync.watermark = snapshot.sync_watermark
+        self._restored_triggers = snapshot.triggers
+        self._restored_channels = [channel_id for channel_id, _, _ in snapshot.buffers]
+        self.restored_servers = len(snapshot.servers)
+        self.restored_server_ids = {server_id for server_id, _ in snapshot.servers}
+        print(
+            f"Restored snapshot from {downtime:.0f}s ago: {len(snapshot.servers)} server(s), "
+            f"{self.restored_messages} buffered message(s), {len(snapshot.triggers)} pending trigger(s)"
+        )
+        return True
+
+    async def revalidate(self, bot) -> None:
+        """After connecting: refetch restored channels' history and answer restored triggers that still apply."""
+        for channel_id, message_id, triggers in self._restored_triggers:
+            config = store.watched_by_channel.get(channel_id)
+            channel = bot.get_channel(channel_id)
+            if config is None or not config.enabled or channel is None or _message_age(message_id) > SNAPSHOT_TRIGGER_MAX_AGE:
+                continue
+            try:
+                message = await channel.fetch_message(message_id)
+            except Exception:
+                continue
+            self.coalescer.trigger(channel_id, message, triggers)
+            self.resumed_triggers += 1
+        self._restored_triggers = []
+
+        semaphore = asyncio.Semaphore(_REVALIDATE_CONCURRENCY)
+
+        async def refetch(channel_id: int) -> None:
+            channel = bot.get_channel(channel_id)
+            if channel is None or channel_id not in store.watched_by_channel:
+                return
+            async with semaphore:
+                try:
+                    await revalidate(channel)
+                    self.revalidated_channels += 1
+                except Exception as e:
+                    print(f"Failed to refetch history for channel {channel_id}: {e}")
+
+        await asyncio.gather(*(refetch(channel_id) for channel_id in self._restored_channels))
+        self._restored_channels = []
+
+    def start(self) -> None:
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save_async()
+
+    def stats(self):
+        return {
+            "saves": self.saves,
+            "failures": self.failures,
+            "last_bytes": self.last_bytes,
+            "last_save_ms": round(self.last_save_ms, 1),
+            "restored_servers": self.restored_servers,
+            "restored_messages": self.restored_messages,
+            "revalidated_channels": self.revalidated_channels,
+            "resumed_triggers": self.resumed_triggers,
+        }
@@ -1,58 +1,206 @@
-"""Server state: watched channels, webhooks, and custom name/avatar per server."""
-from typing import Dict
+"""Server state: watched channel, webhook, and custom name/avatar/personality per server."""
+import asyncio
+import os
+from typing import Callable, Dict, Iterable, List, Optional, Set
 
 from supabase_client import get_supabase
 
-# server_id -> channel_id
-watched_channels: Dict[str, str] = {}
-# server_id -> (webhook_id, webhook_token)
-webhook_by_server: Dict[str, tuple] = {}
-# server_id -> display name for webhook replies
-webhook_name_by_server: Dict[str, str] = {}
-# server_id -> avatar URL for webhook replies
-webhook_avatar_by_server: Dict[str, str] = {}
-# server_id -> personality text for system prompt
-personality_by_server: Dict[str, str] = {}
-# server_id -> whether AI replies are enabled (default True if missing)
-enabled_by_server: Dict[str, bool] = {}
-
-
-async def load_watched_channels() -> None:
-    """Load all watched channels and webhook config from Supabase on startup."""
+LOAD_PAGE_SIZE = int(os.getenv("LOAD_PAGE_SIZE", "1000"))
+# Only the columns the bot uses
+SERVER_COLUMNS = 'server_id, channel_id, webhook_id, webhook_token, webhook_name, webhook_avatar_url, personality, enabled, model_tier'
+
+
+class ServerConfig:
+    """Per-server config with ids pre-parsed to ints (Supabase stores them as text)."""
+    __slots__ = (
+        'server_id',
+        'channel_id',
+        'webhook_id',
+        'webhook_token',
+        'name',
+        'avatar_url',
+        'personality',
+        'enabled',
+        'model_tier',
+    )
+
+    def __init__(self, server_id: int):
+        self.server_id = server_id
+        self.channel_id: Optional[int] = None
+        self.webhook_id: Optional[int] = None
+        self.webhook_token: Optional[str] = None
+        # display name for webhook replies
+        self.name: Optional[str] = None
+        # avatar URL for webhook replies
+        self.avatar_url: Optional[str] = None
+        # personality text for system prompt
+        self.personality: Optional[str] = None
+        # whether AI replies are enabled
+        self.enabled = True
+        # model tier for all replies ("fast"/"full"), or None to route per message (see ai/router.py)
+        self.model_tier: Optional[str] = None
+
+    @property
+    def watching(self) -> bool:
+        """True if the server has a channel and a usable webhook."""
+        return bool(self.channel_id and self.webhook_id and self.webhook_token)
+
+    @property
+    def reply_name(self) -> str:
+        return self.name or "Untitled"
+
+
+# server_id -> config
+servers: Dict[int, ServerConfig] = {}
+# channel_id -> config, only for watched channels; the one lookup every incoming message pays
+watched_by_channel: Dict[int, ServerConfig] = {}
+# Set once the whole `servers` table has been read into the store
+_loaded = False
+# Called with a channel id when its server moves to another channel or is removed, to drop per-channel state
+unwatch_listeners: List[Callable[[int], None]] = []
+
+
+def _to_int(value) -> Optional[int]:
     try:
-        supabase = get_supabase()
-        response = supabase.table('servers').select('*').execute()
-
-        watched_channels.clear()
-        webhook_by_server.clear()
-        webhook_name_by_server.clear()
-        webhook_avatar_by_server.clear()
-        personality_by_server.clear()
-        enabled_by_server.clear()
-
-        for row in response.data:
-            server_id = str(row.get('server_id'))
-            channel_id = str(row.get('channel_id'))
-            wh_id = row.get('webhook_id')
-            wh_token = row.get('webhook_token')
-            if server_id and channel_id:
-                if wh_id and wh_token:
-                    watched_channels[server_id] = channel_id
-                    webhook_by_server[server_id] = (str(wh_id), str(wh_token))
-                name = row.get('webhook_name')
-                avatar = row.get('webhook_avatar_url')
-                if name:
-                    webhook_name_by_server[server_id] = name
-                if avatar:
-                    webhook_avatar_by_server[server_id] = avatar
-                personality = row.get('personality')
-                if personality:
-                    personality_by_server[server_id] = personality
-                enabled = row.get('enabled')
-                if enabled is not None:
-                    enabled_by_server[server_id] = bool(enabled)
-                else:
-                    enabled_by_server[server_id] = True
-                print(f'  - Watching server {server_id}, channel {channel_id}')
-    except Exception as e:
-        print(f'Failed to load watched channels: {e}')
+        return int(value) if value is not None and value != '' else None
+    except (TypeError, ValueError):
+        return None
+
+
+def get_server(server_id: int) -> Optional[ServerConfig]:
+    return servers.get(server_id)
+
+
+def mark_loaded() -> None:
+    global _loaded
+    _loaded = True
+
+
+async def fetch_server(
+    server_id: int,
+    pending: Callable[[int], Iterable[str]] = lambda server_id: (),
+) -> Optional[ServerConfig]:
+    """The server's config, read from the table first if the startup load may not have reached it yet.
+
+    Commands use this before acting on what's already stored (an old webhook, `enabled`);
+    `pending(server_id)` names attributes with unsaved local edits that must not be overwritten.
+    """
+    if not _loaded:
+        supabase = await asyncio.to_thread(get_supabase)
+        query = supabase.table('servers').select(SERVER_COLUMNS).eq('server_id', str(server_id)).limit(1)
+        response = await asyncio.to_thread(query.execute)
+        for row in response.data or []:
+            apply_row(row, skip=pending(server_id))
+    return servers.get(server_id)
+
+
+def ensure_server(server_id: int) -> ServerConfig:
+    """Return the server's config, creating an empty one if needed."""
+    config = servers.get(server_id)
+    if config is None:
+        config = servers[server_id] = ServerConfig(server_id)
+    return config
+
+
+def reindex(config: ServerConfig, old_channel_id: Optional[int] = None) -> None:
+    """Update the channel index after a config's channel or webhook changed."""
+    if old_channel_id is not None and watched_by_channel.get(old_channel_id) is config:
+        del watched_by_channel[old_channel_id]
+    if config.watching:
+        watched_by_channel[config.channel_id] = config
+    elif watched_by_channel.get(config.channel_id) is config:
+        del watched_by_channel[config.channel_id]
+    if old_channel_id is not None and old_channel_id != config.channel_id:
+        _unwatched(old_channel_id)
+
+
+def _unwatched(channel_id: int) -> None:
+    for listener in unwatch_listeners:
+        try:
+            listener(channel_id)
+        except Exception as e:
+            print(f'Unwatch listener failed: {e}')
+
+
+def set_channel(server_id: int, channel_id: int, webhook_id: int, webhook_token: Optional[str]) -> ServerConfig:
+    config = ensure_server(server_id)
+    old_channel_id = config.channel_id
+    config.channel_id = channel_id
+    config.webhook_id = webhook_id
+    config.webhook_token = webhook_token
+    reindex(config, old_channel_id)
+    return config
+
+
+def remove_server(server_id: int) -> Optional[ServerConfig]:
+    """Drop a server's config and its channel index entry."""
+    config = servers.pop(server_id, None)
+    if config is not None and watched_by_channel.get(config.channel_id) is config:
+        del watched_by_channel[config.channel_id]
+    if config is not None and config.channel_id is not None:
+        _unwatched(config.channel_id)
+    return config
+
+
+def apply_values(server_id: int, values: dict) -> ServerConfig:
+    """Set ServerConfig attributes from `values` (attribute -> value) and reindex."""
+    config = ensure_server(server_id)
+    old_channel_id = config.channel_id
+    for attr, value in values.items():
+        if attr in ServerConfig.__slots__ and attr != 'server_id':
+            setattr(config, attr, value)
+    reindex(config, old_channel_id)
+    return config
+
+
+def apply_row(row: dict, skip: Iterable[str] = ()) -> Optional[ServerConfig]:
+    """Load one `servers` table row into the store, leaving attributes in `skip` (unsaved local edits) alone."""
+    server_id = _to_int(row.get('server_id'))
+    if server_id is None:
+        return None
+    values = {
+        'channel_id': _to_int(row.get('channel_id')),
+        'webhook_id': _to_int(row.get('webhook_id')),
+        'webhook_token': str(row['webhook_token']) if row.get('webhook_token') else None,
+        'name': row.get('webhook_name') or None,
+        'avatar_url': row.get('webhook_avatar_url') or None,
+        'personality': row.get('personality') or None,
+        'enabled': bool(row['enabled']) if row.get('enabled') is not None else True,
+        'model_tier': row.get('model_tier') or None,
+    }
+    return apply_values(server_id, {attr: value for attr, value in values.items() if attr not in skip})
+
+
+async def load_servers(
+    page_size: int = LOAD_PAGE_SIZE,
+    pending: Callable[[int], Iterable[str]] = lambda server_id: (),
+    owns: Callable[[int], bool] = lambda server_id: True,
+    seen: Optional[Set[int]] = None,
+) -> int:
+    """Load the `servers` table page by page (keyset on server_id) into the store; returns rows loaded.
+
+    The store is filled as pages arrive, so it can serve messages while loading.
+    `pending(server_id)` names attributes with unsaved local edits that must not be overwritten.
+    In cluster mode `owns(server_id)` limits the store to this process's guilds.
+    The ids of loaded servers are added to `seen`, if given.
+    """
+    supabase = await asyncio.to_thread(get_supabase)
+    last_id = None
+    loaded = 0
+    while True:
+        query = supabase.table('servers').select(SERVER_COLUMNS).order('server_id').limit(page_size)
+        if last_id is not None:
+            query = query.gt('server_id', last_id)
+        response = await asyncio.to_thread(query.execute)
+        rows = response.data or []
+        for row in rows:
+            server_id = _to_int(row.get('server_id'))
+            if server_id is not None and owns(server_id):
+                apply_row(row, skip=pending(server_id))
+                loaded += 1
+                if seen is not None:
+                    seen.add(server_id)
+        if len(rows) < page_size:
+            mark_loaded()
+            return loaded
+        last_id = rows[-1]['server_id']
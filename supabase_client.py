@@ -1,21 +1,26 @@
 """Supabase client. Uses SUPABASE_URL and SUPABASE_KEY from environment."""
 import os
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 from dotenv import load_dotenv
-from supabase import create_client, Client
+
+if TYPE_CHECKING:
+    from supabase import Client
 
 load_dotenv()
 
 url = os.getenv("SUPABASE_URL")
 key = os.getenv("SUPABASE_KEY")
 
-_client: Optional[Client] = None
+_client: Optional["Client"] = None
 
 
-def get_supabase() -> Client:
+def get_supabase() -> "Client":
+    """Return the shared client; the supabase SDK is imported on first call to keep startup fast."""
     if not url or not key:
         raise RuntimeError("SUPABASE_URL and SUPABASE_KEY must be set in .env")
     global _client
     if _client is None:
+        from supabase import create_client
+
         _client = create_client(url, key)
     return _client
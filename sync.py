@@ -0,0 +1,194 @@
+"""Incremental config sync: poll the `servers` table for rows changed since the last sync.
+
+Each row carries an `updated_at` timestamp (set by a trigger, see README) and a
+`deleted_at` soft-delete marker. The sync keeps a watermark of the last
+(updated_at, server_id) seen and pages through newer rows in that order, applying
+them to the store, so edits made in the table or by other bot instances show up
+without a restart or a full reload. The first sync (no watermark) is the full load.
+
+Rows are read through a small source interface: `SupabaseChangeSource` for the real
+table (also works against a local Supabase/Postgres), `MemoryChangeSource` as an
+in-memory stand-in.
+"""
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from store import LOAD_PAGE_SIZE, SERVER_COLUMNS, _to_int, apply_row, mark_loaded, remove_server
+from supabase_client import get_supabase
+
+# Seconds between polls; 0 disables incremental sync (startup does a one-off full load instead)
+CONFIG_SYNC_INTERVAL = float(os.getenv("CONFIG_SYNC_INTERVAL", "0"))
+# Re-read this many seconds behind the watermark, for transactions that committed late
+CONFIG_SYNC_OVERLAP = float(os.getenv("CONFIG_SYNC_OVERLAP", "10"))
+SYNC_COLUMNS = SERVER_COLUMNS + ', updated_at, deleted_at'
+
+# (updated_at, server_id) of the last row seen, as the table returns them
+Cursor = Tuple[str, str]
+
+
+def _parse_ts(value: str) -> datetime:
+    ts = datetime.fromisoformat(value)
+    return ts if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+
+
+def _row_key(row: dict) -> Tuple[datetime, str]:
+    return _parse_ts(row['updated_at']), str(row['server_id'])
+
+
+class SupabaseChangeSource:
+    """Reads changed rows from the `servers` table through PostgREST."""
+
+    async def fetch(self, after: Optional[Cursor], limit: int) -> List[dict]:
+        """Up to `limit` rows ordered by (updated_at, server_id) strictly after `after`.
+
+        Without a cursor this is a full load, so soft-deleted rows are left out.
+        """
+        supabase = await asyncio.to_thread(get_supabase)
+        query = supabase.table('servers').select(SYNC_COLUMNS).order('updated_at').order('server_id').limit(limit)
+        if after is None:
+            query = query.is_('deleted_at', 'null')
+        else:
+            ts, server_id = after
+            query = query.or_(f'updated_at.gt."{ts}",and(updated_at.eq."{ts}",server_id.gt."{server_id}")')
+        response = await asyncio.to_thread(query.execute)
+        return response.data or []
+
+
+class MemoryChangeSource:
+    """In-memory stand-in for the `servers` table, stamping updated_at like the trigger does."""
+
+    def __init__(self):
+        self.rows: Dict[str, dict] = {}
+        self._clock = datetime.now(timezone.utc)
+
+    def _now(self) -> str:
+        # Strictly increasing, like a transaction clock would be for serialized writes
+        self._clock = max(datetime.now(timezone.utc), self._clock + timedelta(microseconds=1))
+        return self._clock.isoformat()
+
+    def upsert(self, row: dict) -> None:
+        server_id = str(row['server_id'])
+        merged = {**self.rows.get(server_id, {}), **row, 'server_id': server_id}
+        merged['updated_at'] = self._now()
+        merged.setdefault('deleted_at', None)
+        self.rows[server_id] = merged
+
+    def delete(self, server_id) -> None:
+        row = self.rows.get(str(server_id))
+        if row is not None:
+            row['deleted_at'] = row['updated_at'] = self._now()
+
+    async def fetch(self, after: Optional[Cursor], limit: int) -> List[dict]:
+        rows = sorted(self.rows.values(), key=_row_key)
+        if after is None:
+            rows = [r for r in rows if not r.get('deleted_at')]
+        else:
+            cursor = (_parse_ts(after[0]), after[1])
+            rows = [r for r in rows if _row_key(r) > cursor]
+        return [dict(r) for r in rows[:limit]]
+
+
+class ConfigSync:
+    """Applies changed `servers` rows to the store, from a watermark, on a timer."""
+
+    def __init__(
+        self,
+        source=None,
+        interval: float = CONFIG_SYNC_INTERVAL,
+        overlap: float = CONFIG_SYNC_OVERLAP,
+        page_size: int = LOAD_PAGE_SIZE,
+    ):
+        self.source = source or SupabaseChangeSource()
+        self.interval = interval
+        self.overlap = overlap
+        self.page_size = page_size
+        self.watermark: Optional[Cursor] = None
+        # Attributes with unsaved local edits, which the table must not overwrite
+        self.pending: Callable[[int], Iterable[str]] = lambda server_id: ()
+        # In cluster mode, limits the store to this process's guilds
+        self.owns: Callable[[int], bool] = lambda server_id: True
+        # Called with the ids of the live rows once a full load (no watermark) has completed
+        self.loaded: Callable[[Set[int]], None] = lambda server_ids: None
+        # Ids read so far by an unfinished full load (kept across retries)
+        self._full_load: Optional[Set[int]] = None
+        self._task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.applied = 0
+        self.deleted = 0
+        self.failures = 0
+
+    def _apply(self, row: dict) -> None:
+        server_id = _to_int(row.get('server_id'))
+        if server_id is None or not self.owns(server_id):
+            return
+        skip = set(self.pending(server_id))
+        if row.get('deleted_at'):
+            # A local edit since the delete wins; it will recreate the row when flushed
+            if not skip and remove_server(server_id) is not None:
+                self.deleted += 1
+            return
+        apply_row(row, skip=skip)
+        self.applied += 1
+        if self._full_load is not None:
+            self._full_load.add(server_id)
+
+    async def sync_once(self) -> int:
+        """Pull and apply everything changed since the watermark; returns rows read."""
+        after = self.watermark
+        if after is None:
+            self._full_load = set()
+        elif self.overlap:
+            # Rewind so rows from transactions that committed after our last read are not missed
+            after = ((_parse_ts(after[0]) - timedelta(seconds=self.overlap)).isoformat(), '')
+        read = 0
+        while True:
+            rows = await self.source.fetch(after, self.page_size)
+            for row in rows:
+                self._apply(row)
+            read += len(rows)
+            if rows:
+                after = (rows[-1]['updated_at'], str(rows[-1]['server_id']))
+                if self.watermark is None or _row_key(rows[-1]) > (_parse_ts(self.watermark[0]), self.watermark[1]):
+                    self.watermark = after
+            if len(rows) < self.page_size:
+                break
+        self.polls += 1
+        # The store now has every row (the first pass is the full load)
+        mark_loaded()
+        if self._full_load is not None:
+            seen, self._full_load = self._full_load, None
+            self.loaded(seen)
+        return read
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        backoff = self.interval
+        while True:
+            try:
+                read = await self.sync_once()
+                if self.polls == 1:
+                    print(f'Loaded {read} server row(s) from database')
+                backoff = self.interval
+            except Exception as e:
+                self.failures += 1
+                backoff = min(max(backoff * 2, self.interval), 300.0)
+                print(f'Config sync failed, retrying in {backoff:.0f}s: {e}')
+            await asyncio.sleep(backoff)
+
+    def stats(self) -> Dict[str, float]:
+        lag = (datetime.now(timezone.utc) - _parse_ts(self.watermark[0])).total_seconds() if self.watermark else 0.0
+        return {
+            "polls": self.polls,
+            "applied": self.applied,
+            "deleted": self.deleted,
+            "failures": self.failures,
+            "watermark_age": round(lag, 1),
+        }
+
+
+config_sync = ConfigSync()